@@ -2,6 +2,9 @@ import argparse
 import logging
 from os.path import isfile, join
 
+from codec import NAMES
+from ordering import ORDERS
+
 parser = argparse.ArgumentParser(description="Process some integers.")
 
 parser.add_argument("-v", "--verbose", action="count", default=0)
@@ -50,6 +53,14 @@ path.add_argument(
 path.add_argument(
     "--sort", action="store_true", help="Sort partitions on targets before sending"
 )
+path.add_argument(
+    "--batch-order",
+    type=str,
+    choices=ORDERS,
+    default="none",
+    help="Order of the queries in each partition: by target, by CPD block of "
+    "the target, or along a Hilbert curve over the sources' coordinates.",
+)
 
 path.add_argument("--s-lim", default=0, type=int, help="Time limit in seconds")
 path.add_argument("--ms-lim", default=0, type=int, help="Time limit in milliseconds")
@@ -127,10 +138,25 @@ rand.add_argument(
 
 server = parser.add_argument_group("server")
 server.add_argument(
-    "--host", type=str, default="localhost", help="Server to connect to."
+    "--host", type=str, default="localhost", help="Address the query server listens on."
 )
 server.add_argument(
-    "--port", type=int, default=9999, help="Port to send information to on the server."
+    "--port", type=int, default=9999, help="Port the query server listens on."
+)
+server.add_argument(
+    "--unix", type=str, help="Listen on this Unix socket instead of --host/--port."
+)
+server.add_argument(
+    "--window-ms",
+    type=float,
+    default=5,
+    help="Longest wait, in milliseconds, for a micro-batch to fill up.",
+)
+server.add_argument(
+    "--window-size",
+    type=int,
+    default=256,
+    help="Largest number of queries in a micro-batch.",
 )
 
 fifo = parser.add_argument_group("fifo")
@@ -171,6 +197,129 @@ fifo.add_argument(
 fifo.add_argument(
     "--no-cache", action="store_true", help="Disable runtime cache in workers."
 )
+fifo.add_argument(
+    "--spill",
+    action="store_true",
+    help="Read and partition the text scenario in one pass, a chunk at a time, "
+    "into per-worker query files on the NFS, instead of loading it.",
+)
+fifo.add_argument(
+    "--chunk-size",
+    type=int,
+    default=0,
+    help="Stream partitions to the workers in chunks of this many queries, "
+    "0 sends each partition at once.",
+)
+fifo.add_argument(
+    "--batch-size",
+    type=int,
+    default=0,
+    help="Split each shard into micro-batches of this many queries, sent to "
+    "whichever of its replicas is free first, 0 sends each shard at once.",
+)
+fifo.add_argument(
+    "--speculate",
+    type=float,
+    default=0,
+    help="Offer a batch to another replica of its shard once it runs this many "
+    "times longer than the shard's observed service time, 0 never does.",
+)
+fifo.add_argument(
+    "--speculate-min",
+    type=float,
+    default=1.0,
+    help="Shortest deadline of a batch in seconds, with --speculate.",
+)
+fifo.add_argument(
+    "--wire",
+    type=str,
+    choices=["text", "binary"],
+    default="text",
+    help="Format of the query files and answers exchanged with the workers.",
+)
+fifo.add_argument(
+    "--codec",
+    type=str,
+    choices=NAMES,
+    default="none",
+    help="Compress the binary query files and answers of large batches, auto "
+    "picks the fastest installed codec. The cluster config may set it per host.",
+)
+fifo.add_argument(
+    "--timeout",
+    type=float,
+    default=0,
+    help="Seconds to wait for a worker's answer, 0 waits forever.",
+)
+fifo.add_argument(
+    "--connect-limit",
+    type=int,
+    default=8,
+    help="Maximum number of concurrent ssh handshakes per host.",
+)
+fifo.add_argument(
+    "--host-limit",
+    type=int,
+    default=0,
+    help="Maximum number of batches in flight per host, 0 means no limit.",
+)
+fifo.add_argument(
+    "--per-query",
+    action="store_true",
+    help="Collect the result of every query in the output directory, needs --wire binary.",
+)
+fifo.add_argument(
+    "--dedup",
+    action="store_true",
+    help="Send each distinct (source, target) pair once per diff.",
+)
+fifo.add_argument(
+    "--result-cache",
+    type=str,
+    help="Directory of the head-node cache of per-query results, needs --wire binary.",
+)
+fifo.add_argument(
+    "--cache-size",
+    type=int,
+    default=1024,
+    help="Size limit of the result cache in MB.",
+)
+fifo.add_argument(
+    "--wait-ready",
+    type=float,
+    default=0,
+    help="Wait up to this many seconds for every worker to be ready (see "
+    "make_fifos.py) before sending queries, 0 does not check.",
+)
+fifo.add_argument(
+    "--shm",
+    action="store_true",
+    help="Pass the batches of workers on this host through shared memory, "
+    "without ssh nor NFS files. Needs --wire binary.",
+)
+fifo.add_argument(
+    "--fifo-dir",
+    type=str,
+    default="/tmp",
+    help="Directory of the workers' FIFO pairs (worker<id>.fifo and .answer). "
+    "fifo_auto uses /tmp, other places are for stand-in workers.",
+)
+fifo.add_argument(
+    "--local-shell",
+    action="store_true",
+    help="Run the workers' shells on this host instead of over ssh, e.g., with "
+    "fake_worker.py.",
+)
+fifo.add_argument(
+    "--trace",
+    type=str,
+    help="Save a Chrome trace (chrome://tracing, Perfetto) of the run to this file.",
+)
+fifo.add_argument(
+    "--check-dist",
+    action="store_true",
+    help="Check the node distribution against ./bin/gen_distribute_conf.",
+)
 
 modus = parser.add_mutually_exclusive_group()
 modus.add_argument("--div", type=int, help="Assign nodes to $#host = target / div$")
@@ -0,0 +1,209 @@
+# Benchmarks of the head-node hot paths, no cluster nor C++ needed.
+# Generates a synthetic .xy header and .scen files, then times:
+#   - read_p2p, parsing the text scenario and from its cache
+#   - make_parts, for every partmethod
+#   - writing the query files, text and binary
+#   - dispatch to local stand-in workers (fake_worker.py) through bash
+# Results are printed as JSON lines and can be saved as a baseline, later
+# runs are compared against it.
+#
+# Usage: python bench.py [--sizes 1e5 1e6] [-o bench.json] [--baseline bench.json]
+
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+from os.path import join
+
+import numpy as np
+
+from scenario import read_p2p, cache_name
+from partition import node_table, cache_name as dist_cache_name
+import process_query
+from args import parser as driver_parser
+
+
+# Write synthetic files this many lines at a time
+CHUNK_LINES = 1 << 20
+
+
+def synth_xy(fname, nodenum, seed=0):
+    """A .xy file with random coordinates and no edge"""
+    rng = np.random.default_rng(seed)
+    with open(fname, "w") as f:
+        f.write("c synthetic graph\nc\nc\n")
+        f.write(f"nodes {nodenum} edges 0\n")
+        for start in range(0, nodenum, CHUNK_LINES):
+            ids = np.arange(start, min(nodenum, start + CHUNK_LINES))
+            rows = np.column_stack([ids, rng.integers(0, 1 << 20, (len(ids), 2))])
+            np.savetxt(f, rows, fmt="v %d %d %d")
+
+
+def synth_scen(fname, size, nodenum, seed=0):
+    """A .scen file of uniformly random queries"""
+    rng = np.random.default_rng(seed)
+    with open(fname, "w") as f:
+        f.write("version 1\n")
+        for start in range(0, size, CHUNK_LINES):
+            n = min(size - start, CHUNK_LINES)
+            np.savetxt(f, rng.integers(0, nodenum, (n, 2)), fmt="q %d %d")
+
+
+def timed(fn, repeat):
+    """Best wall time of `repeat` calls, and the last result"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        res = fn()
+        best = min(best, timeit.default_timer() - start)
+    return best, res
+
+
+def bench_read(sce_name, repeat):
+    cname = cache_name(sce_name)
+    if os.path.exists(cname):
+        os.remove(cname)
+    yield "read_p2p.parse", timed(lambda: read_p2p(sce_name, use_cache=False), repeat)[0]
+    read_p2p(sce_name)
+    yield "read_p2p.cache", timed(lambda: np.asarray(read_p2p(sce_name)).sum(), repeat)[0]
+
+
+def bench_parts(reqs, nodenum, nworkers, repeat):
+    for method, key in [("mod", nworkers), ("div", -(-nodenum // nworkers))]:
+        cname = dist_cache_name(nodenum, nworkers, method, key)
+        if os.path.exists(cname):
+            os.remove(cname)
+        cold, _ = timed(lambda: node_table(nodenum, nworkers, method, key), 1)
+        yield f"node_table.{method}", cold
+        warm, _ = timed(
+            lambda: process_query.make_parts(reqs, nodenum, nworkers, method, key, -1),
+            repeat,
+        )
+        yield f"make_parts.{method}", warm
+
+
+def bench_write(reqs, tmpdir, repeat):
+    qname = join(tmpdir, "query.bench")
+    for fmt in ["text", "binary"]:
+        config = {"wire": fmt}
+        yield f"write_queries.{fmt}", timed(
+            lambda: process_query.write_queries(qname, reqs, config, "-"), repeat
+        )[0]
+    os.remove(qname)
+
+
+def bench_dispatch(reqs, nodenum, nworkers, tmpdir, ndiffs, batch_size):
+    # Private FIFOs, away from real or leftover workers on this machine
+    fifos = [join(tmpdir, f"worker{i}.fifo") for i in range(nworkers)]
+    for fifo in fifos:
+        if not os.path.exists(fifo):
+            os.mkfifo(fifo)
+    here = os.path.dirname(os.path.abspath(__file__))
+    worker = subprocess.Popen([sys.executable, join(here, "fake_worker.py"), *fifos])
+    try:
+        _, parts = process_query.make_parts(reqs, nodenum, nworkers, "mod", nworkers, -1)
+        replicas = [["localhost"]] * nworkers
+        for fmt in ["text", "binary"]:
+            args = driver_parser.parse_args([
+                "--wire", fmt, "--local-shell", "--batch-size", str(batch_size),
+                "--fifo-dir", tmpdir,
+            ])
+            config = process_query.worker_config(args)
+            if fmt == "binary":
+                config["per_query"] = True
+            diffs = ["-"] * ndiffs
+            start = timeit.default_timer()
+            with open(os.devnull, "w") as devnull:
+                # send_queries reports every batch
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    asyncio.run(process_query.dispatch(
+                        range(nworkers), replicas, reqs, [parts] * ndiffs, tmpdir,
+                        config, diffs, args,
+                    ))
+                finally:
+                    sys.stdout = stdout
+            yield f"dispatch.{fmt}", timeit.default_timer() - start
+    finally:
+        worker.kill()
+        worker.wait()
+
+
+def run(size, args, tmpdir):
+    xy = join(tmpdir, "bench.xy")
+    sce = join(tmpdir, f"bench-{size}.scen")
+    synth_xy(xy, args.nodenum)
+    synth_scen(sce, size, args.nodenum)
+
+    results = list(bench_read(sce, args.repeat))
+    reqs = read_p2p(sce)
+    results += bench_parts(reqs, args.nodenum, args.workers, args.repeat)
+    results += bench_write(reqs, tmpdir, args.repeat)
+    if not args.no_dispatch:
+        results += bench_dispatch(reqs, args.nodenum, args.workers, tmpdir, args.diffs,
+                                  args.batch_size)
+    return [
+        {"name": name, "size": size, "seconds": t, "qps": size / t if t else 0}
+        for name, t in results
+    ]
+
+
+def compare(results, baseline, tolerance):
+    """Print the ratio to the baseline of every benchmark, return the regressions"""
+    base = {(r["name"], r["size"]): r["seconds"] for r in baseline}
+    slower = []
+    for r in results:
+        ref = base.get((r["name"], r["size"]))
+        if ref is None:
+            continue
+        ratio = r["seconds"] / ref
+        flag = ""
+        if ratio > tolerance:
+            slower.append(r)
+            flag = "  REGRESSION"
+        print(f"{r['name']:24} {r['size']:>12} {ratio:6.2f}x baseline{flag}")
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1e5],
+            help="number of queries of each scenario, e.g. 1e5 1e6")
+    parser.add_argument("--nodenum", type=int, default=100000, help="number of nodes")
+    parser.add_argument("--workers", type=int, default=4, help="number of (fake) workers")
+    parser.add_argument("--diffs", type=int, default=2, help="number of diffs to dispatch")
+    parser.add_argument("--batch-size", type=int, default=0, help="micro-batch size")
+    parser.add_argument("--repeat", type=int, default=3, help="keep the best of this many runs")
+    parser.add_argument("--no-dispatch", action="store_true", help="skip the dispatch benchmark")
+    parser.add_argument("--dir", type=str, help="directory of the synthetic files")
+    parser.add_argument("-o", type=str, help="save the results to this JSON file")
+    parser.add_argument("--baseline", type=str, help="JSON results to compare to")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+            help="slowdown over the baseline reported as a regression")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        results = []
+        for size in args.sizes:
+            for r in run(int(size), args, tmpdir):
+                print(json.dumps(r))
+                results.append(r)
+
+    if args.o is not None:
+        with open(args.o, "w") as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+#
+# Persistent channels to the workers.
+# One long-lived `ssh host bash -s` per FIFO, reused by every batch of every
+# diff, so a batch only costs a heredoc write and a read of the answer.
+# Channels are driven by asyncio, so a single head-node thread can serve
+# hundreds of workers. Workers on the head node's own host can instead be
+# reached through their FIFOs directly (LocalChannel), with the batches in
+# shared memory (see shm.py).
+#
+import asyncio
+import errno
+import os
+import signal
+import socket
+import stat
+from asyncio.subprocess import PIPE
+from collections import deque, defaultdict
+from contextlib import nullcontext
+
+from tracing import Span
+
+
+# Printed by the remote shell after each answer, followed by the exit status
+SENTINEL = b"__warthog_done__"
+
+# Exit status reported when a request times out, as with timeout(1)
+TIMEOUT = 124
+
+
+class ChannelError(Exception):
+    pass
+
+
+class Channel:
+    """A shell on a worker, talking to one resident FIFO process"""
+
+    def __init__(self, hostname, fifo, answer, retries=1, binary=False,
+                 timeout=None, connect_sem=None, host_sem=None, shell=None):
+        self.hostname = hostname
+        self.fifo = fifo
+        self.answer = answer
+        self.retries = retries
+        # Binary answers are returned as bytes, text ones as a stripped string
+        self.binary = binary
+        # Seconds to wait for an answer, None waits forever
+        self.timeout = timeout
+        # Limit concurrent ssh handshakes and requests on the same host
+        self.connect_sem = connect_sem or asyncio.Semaphore(1)
+        self.host_sem = host_sem
+        # Command running the shell, ssh to the host by default
+        self.shell = shell or ["ssh", "-T", hostname, "bash -s"]
+        self.proc = None
+        # Answers of timed-out requests still to come on the shell, dropped
+        self.owed = 0
+        # Killed shells, reaped when the channel is closed
+        self.dropped = []
+        self.lock = asyncio.Lock()
+
+    def alive(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    async def open(self):
+        async with self.connect_sem:
+            with Span("connect", "channel", host=self.hostname):
+                # In its own process group, so `kill` also takes its children
+                self.proc = await asyncio.create_subprocess_exec(
+                    *self.shell, stdin=PIPE, stdout=PIPE, start_new_session=True,
+                )
+                # The answer pipe lives as long as the channel
+                await self.write(f"[ -p {self.answer} ] || mkfifo {self.answer}\n")
+
+    def kill(self):
+        """Drop the shell right away, e.g., when a request is cancelled"""
+        if self.alive():
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        if self.proc is not None:
+            self.dropped.append(self.proc)
+        self.proc = None
+        self.owed = 0
+
+    async def close(self):
+        if self.proc is not None:
+            try:
+                await self.write(f"rm -f {self.answer}\nexit\n")
+                self.proc.stdin.close()
+                await asyncio.wait_for(self.proc.wait(), 10)
+            except (OSError, ChannelError, asyncio.TimeoutError):
+                pass
+            finally:
+                self.kill()
+
+        for proc in self.dropped:
+            await proc.wait()
+        self.dropped.clear()
+
+    async def write(self, script):
+        try:
+            self.proc.stdin.write(script.encode())
+            await self.proc.stdin.drain()
+        except (OSError, AttributeError) as e:
+            raise ChannelError(f"Cannot write to '{self.hostname}': {e}")
+
+    async def readline(self):
+        line = await self.proc.stdout.readline()
+        if not line:
+            raise ChannelError(f"Lost connection to '{self.hostname}'")
+        return line
+
+    async def submit(self, config):
+        """Queue a runtime configuration for the FIFO on the remote shell"""
+        await self.write(
+            f"cat <<CONF > {self.fifo}\n{config}CONF\n"  # HEREDOC
+            f"cat {self.answer}\n"
+            # The answer may not end with a newline, start the sentinel's line
+            f"printf '\\n{SENTINEL.decode()} %d\\n' $?\n"
+        )
+
+    async def receive(self):
+        """Wait for the answer of the oldest submitted configuration"""
+        out = []
+        while True:
+            line = await self.readline()
+            if line.startswith(SENTINEL):
+                code = int(line.split()[1])
+                break
+            out.append(line)
+
+        out = b"".join(out)[:-1]
+        if self.binary:
+            return code, out
+        return code, out.decode().strip()
+
+    async def drain(self):
+        """
+        Read and drop the late answers of timed-out requests, which the worker
+        sends before it reads another request. False if they are still late.
+        """
+        try:
+            while self.owed:
+                with Span("drain", "channel", host=self.hostname):
+                    await asyncio.wait_for(self.receive(), self.timeout)
+                self.owed -= 1
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def late(self):
+        return TIMEOUT, f"'{self.hostname}' still late on a timed-out request after {self.timeout}s"
+
+    async def request(self, config):
+        """Pass a runtime configuration to the FIFO and wait for its answer"""
+        with Span("submit", "channel", host=self.hostname):
+            await self.submit(config)
+        with Span("wait", "channel", host=self.hostname):
+            return await asyncio.wait_for(self.receive(), self.timeout)
+
+    async def send(self, config):
+        """Same as `request`, reconnecting on failure"""
+        async with self.lock, self.limit():
+            for attempt in range(self.retries + 1):
+                try:
+                    if not self.alive():
+                        await self.open()
+                    if not await self.drain():
+                        return self.late()
+                    return await self.request(config)
+                except ChannelError as e:
+                    print(f"{e} (attempt {attempt + 1})")
+                    await self.close()
+                except asyncio.TimeoutError:
+                    # The worker still owes the answer, and would give it to
+                    # the next request: keep the shell to read and drop it
+                    self.owed += 1
+                    return TIMEOUT, f"No answer from '{self.hostname}' after {self.timeout}s"
+                except asyncio.CancelledError:
+                    self.kill()
+                    raise
+
+        return 255, f"Cannot reach '{self.hostname}'"
+
+    async def pipeline(self, configs, depth=2):
+        """
+        Send runtime configurations from an async iterable, keeping up to
+        `depth` of them queued on the remote shell so the next one reaches the
+        FIFO as soon as the current one is answered. Yield (code, answer) in
+        order.
+        """
+        configs = aiter(configs)
+        pending = deque()
+        attempt = 0
+        async with self.lock, self.limit():
+            while True:
+                try:
+                    if not self.alive():
+                        await self.open()
+                        # Whatever was queued on the lost shell is sent again
+                        for config in pending:
+                            await self.submit(config)
+                    if not await self.drain():
+                        yield self.late()
+                        return
+                    while len(pending) < depth:
+                        config = await anext(configs, None)
+                        if config is None:
+                            break
+                        pending.append(config)
+                        await self.submit(config)
+                    if not pending:
+                        return
+                    with Span("wait", "channel", host=self.hostname):
+                        res = await asyncio.wait_for(self.receive(), self.timeout)
+                    pending.popleft()
+                    yield res
+                except ChannelError as e:
+                    attempt += 1
+                    print(f"{e} (attempt {attempt})")
+                    await self.close()
+                    if attempt > self.retries:
+                        yield 255, f"Cannot reach '{self.hostname}'"
+                        return
+                except asyncio.TimeoutError:
+                    # As in `send`, the answers of the queued requests are
+                    # dropped before the next request
+                    self.owed += len(pending)
+                    yield TIMEOUT, f"No answer from '{self.hostname}' after {self.timeout}s"
+                    return
+                except GeneratorExit:
+                    # Closed early, e.g., on a bad answer: the queued requests
+                    # are answered all the same, and dropped likewise
+                    self.owed += len(pending)
+                    raise
+                except asyncio.CancelledError:
+                    # Requests may still be queued on the shell, drop it
+                    self.kill()
+                    raise
+
+    def limit(self):
+        return self.host_sem or nullcontext()
+
+
+class LocalChannel:
+    """
+    A FIFO process on this host, reached without ssh nor shell. Its answer is
+    a single line, e.g., the size of an answer left in shared memory.
+    """
+
+    def __init__(self, hostname, fifo, answer, timeout=None, host_sem=None):
+        self.hostname = hostname
+        self.fifo = fifo
+        self.answer = answer
+        self.timeout = timeout
+        self.host_sem = host_sem
+        # One request at a time on a FIFO, as with Channel
+        self.lock = asyncio.Lock()
+
+    async def send(self, config):
+        async with self.lock, self.host_sem or nullcontext():
+            with Span("wait", "channel", host=self.hostname):
+                return await send_fifo(self.fifo, self.answer, config, self.timeout)
+
+    async def close(self):
+        pass
+
+
+def local_hosts():
+    """Names of this host"""
+    return {"localhost", "127.0.0.1", "::1", socket.gethostname(), socket.getfqdn()}
+
+
+class Channels:
+    """
+    Channels for a whole run, keyed by (hostname, fifo).
+
+    At most `connect_limit` ssh handshakes run at once on a host (sshd drops
+    too many concurrent unauthenticated connections) and, if `host_limit` is
+    set, at most that many requests are in flight on a host. With `shell`,
+    e.g. ["bash", "-s"], shells run that command instead of ssh to the host.
+    With `shm`, `local` also gives channels to the FIFOs of this host. The
+    FIFO pairs of the workers are in `fifo_dir`.
+    """
+
+    def __init__(self, retries=1, binary=False, timeout=None, connect_limit=8,
+                 host_limit=0, shell=None, shm=False, fifo_dir="/tmp"):
+        self.retries = retries
+        self.fifo_dir = fifo_dir
+        self.shell = shell
+        self.binary = binary
+        self.timeout = timeout
+        self.connect_sems = defaultdict(lambda: asyncio.Semaphore(connect_limit))
+        self.host_sems = defaultdict(
+            lambda: asyncio.Semaphore(host_limit) if host_limit > 0 else None
+        )
+        self.channels = {}
+        self.local_hosts = local_hosts() if shm else set()
+        self.locals = {}
+
+    def fifo_pair(self, workerid):
+        """FIFO and answer pipe of a worker's resident process"""
+        return (os.path.join(self.fifo_dir, f"worker{workerid}.fifo"),
+                os.path.join(self.fifo_dir, f"worker{workerid}.answer"))
+
+    def get(self, hostname, fifo, answer):
+        key = (hostname, fifo)
+        if key not in self.channels:
+            self.channels[key] = Channel(
+                hostname, fifo, answer, self.retries, self.binary, self.timeout,
+                self.connect_sems[hostname], self.host_sems[hostname], self.shell,
+            )
+        return self.channels[key]
+
+    def local(self, hostname, fifo, answer):
+        """Channel to a FIFO of this host without ssh, None for other hosts"""
+        if hostname not in self.local_hosts:
+            return None
+        if fifo not in self.locals:
+            self.locals[fifo] = LocalChannel(
+                hostname, fifo, answer, self.timeout, self.host_sems[hostname],
+            )
+        return self.locals[fifo]
+
+    async def close(self):
+        await asyncio.gather(*(c.close() for c in self.channels.values()))
+        self.channels.clear()
+        self.locals.clear()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+async def open_fifo(path, flags, timeout=None, poll=0.01):
+    """Open a FIFO without blocking, waiting for its other end up to timeout"""
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    while True:
+        try:
+            return os.open(path, flags | os.O_NONBLOCK)
+        except OSError as e:
+            # No reader on the other end yet, or the FIFO is not created yet
+            if e.errno not in (errno.ENXIO, errno.ENOENT):
+                raise
+        if deadline is not None and loop.time() > deadline:
+            raise asyncio.TimeoutError
+        await asyncio.sleep(poll)
+
+
+async def send_fifo(fifo, answer, config, timeout=None, poll=0.01):
+    """Local counterpart of `Channel.send` for a FIFO process on this host"""
+    # A worker answering after a timeout may have created a regular file
+    if os.path.exists(answer) and not stat.S_ISFIFO(os.stat(answer).st_mode):
+        os.remove(answer)
+    if not os.path.exists(answer):
+        os.mkfifo(answer)
+    loop = asyncio.get_running_loop()
+    transport = None
+    try:
+        fd = await open_fifo(fifo, os.O_WRONLY, timeout, poll)
+        try:
+            data = config.encode()
+            while data:
+                try:
+                    data = data[os.write(fd, data):]
+                except BlockingIOError:
+                    await asyncio.sleep(poll)
+        finally:
+            os.close(fd)
+
+        # Read only: the pipe is not readable before the worker opens it, and
+        # reports EOF once the worker closes it, whether or not the answer
+        # ends with a newline
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader),
+            os.fdopen(os.open(answer, os.O_RDONLY | os.O_NONBLOCK), "rb", 0),
+        )
+        out = await asyncio.wait_for(reader.read(), timeout)
+    except asyncio.TimeoutError:
+        return TIMEOUT, f"No answer from '{fifo}' after {timeout}s"
+    finally:
+        if transport is not None:
+            transport.close()
+        # Never left for a late worker to answer the next request with
+        os.remove(answer)
+
+    return 0, out.decode().strip()
@@ -0,0 +1,27 @@
+#
+# Helpers shared by the scripts reading a cluster configuration.
+#
+
+
+def partition_replicas(conf):
+    """
+    Hosts serving every partition, indexed by partition (i.e., worker) id.
+
+    An entry of `workers` is either a host name or a list of hosts holding
+    replicas of the same CPD shards. `partitions` in the cluster config sets
+    how many partitions each worker runs, either one number for all workers or
+    one per worker (default 1). Each partition has its own CPD shard and its
+    own resident process, with the FIFO pair /tmp/worker{id}.fifo and
+    /tmp/worker{id}.answer, on every host that serves it.
+    """
+    workers = [w if isinstance(w, list) else [w] for w in conf["workers"]]
+    nparts = conf.get("partitions", 1)
+    if isinstance(nparts, int):
+        nparts = [nparts] * len(workers)
+    assert len(nparts) == len(workers), "Need one partition count per worker"
+
+    for hosts in workers:
+        # Replicas on the same host would share a FIFO pair
+        assert len(set(hosts)) == len(hosts), f"Duplicate replica in {hosts}"
+
+    return [hosts for hosts, k in zip(workers, nparts) for _ in range(k)]
@@ -0,0 +1,75 @@
+#
+# Optional compression of the binary query files and answers.
+# zlib and lzma come with Python, lz4 and zstd are used when installed. The
+# codec of a worker is named in its runtime configuration ("codec"), and a
+# payload is only compressed, with the COMPRESSED header flag (see wire.py),
+# when it is large enough and compression pays off.
+#
+import lzma
+import zlib
+
+
+# name: (compress, decompress)
+CODECS = {
+    "zlib": (lambda b: zlib.compress(b, 1), zlib.decompress),
+    "lzma": (lambda b: lzma.compress(b, preset=0), lzma.decompress),
+}
+
+try:
+    import lz4.frame
+    CODECS["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+try:
+    import zstandard
+    CODECS["zstd"] = (
+        lambda b: zstandard.ZstdCompressor(level=1).compress(b),
+        lambda b: zstandard.ZstdDecompressor().decompress(b),
+    )
+except ImportError:
+    pass
+
+NAMES = ["none", "auto", "zlib", "lzma", "lz4", "zstd"]
+# Picked by "auto", fastest first
+PREFERRED = ["lz4", "zstd", "zlib"]
+
+# Payloads smaller than this are sent as they are
+MIN_BYTES = 1 << 16
+# Compressed payloads larger than this fraction of the raw one are not worth it
+MAX_RATIO = 0.9
+
+
+def resolve(name):
+    """Codec to use for `name`, None for no compression"""
+    if name in (None, "none"):
+        return None
+    if name == "auto":
+        return next(c for c in PREFERRED if c in CODECS)
+    if name not in CODECS:
+        print(f"Codec '{name}' is not installed, using zlib")
+        return "zlib"
+    return name
+
+
+def compress(codec, raw):
+    """
+    Payload to send and whether it is compressed: small or incompressible
+    payloads are left as they are.
+    """
+    if codec is None or len(raw) < MIN_BYTES:
+        return raw, False
+    packed = CODECS[codec][0](raw)
+    if len(packed) > MAX_RATIO * len(raw):
+        return raw, False
+    return packed, True
+
+
+def decompress(codec, data):
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec '{codec}'")
+    try:
+        return CODECS[codec][1](data)
+    except Exception as e:
+        # Each library has its own error type
+        raise ValueError(f"Cannot decompress with {codec}: {e}")
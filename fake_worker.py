@@ -0,0 +1,91 @@
+# Stand-in for fifo_auto, to run the drivers without a cluster.
+# Speaks the same FIFO protocol: reads a runtime configuration and a
+# "<query file> <answer pipe> <diff>" line from its FIFO, reads the query file
+# (text or binary) and answers right away with made-up statistics, and
+# per-query results if the query file asks for them. No search is done.
+# With a fourth field on that line, the answer is written to that file (a
+# shared memory segment of the driver) and only its size goes to the pipe.
+#
+# Usage: python fake_worker.py /tmp/worker0.fifo [/tmp/worker1.fifo ...]
+
+
+import json
+import os
+import threading
+from sys import argv
+
+import numpy as np
+
+import wire
+
+
+def read_queries(qname, config):
+    """Queries of a query file, and its header (None for text files)"""
+    if config.get("wire") == "binary":
+        with open(qname, "rb") as f:
+            buf = f.read()
+        reqs, _ = wire.read_queries(buf, config.get("codec"))
+        return reqs, wire.read_header(buf, wire.MAGIC_QUERY)
+    with open(qname) as f:
+        f.readline()
+        reqs = np.fromstring(f.read(), dtype=np.uint32, sep=" ")
+    return reqs.reshape(-1, 2), None
+
+
+def answer(reqs, config, head):
+    """
+    Answer in the format of the query, one expansion per query. A binary
+    answer copies the flags, diff id and config hash of the query's header.
+    """
+    n = len(reqs)
+    if config.get("wire") != "binary":
+        return f"{n},{n},{n},{n},0,{n},{n},0,0,0".encode()
+
+    _, _, flags, _, did, chash = head
+    stats = np.zeros(1, dtype=wire.ANSWER)
+    for name in ["n_expanded", "n_inserted", "n_touched", "n_updated", "plen", "finished"]:
+        stats[name] = n
+    results = np.zeros(n if flags & wire.PER_QUERY else 0, dtype=wire.RESULT)
+    results["index"] = np.arange(len(results))
+    results["cost"] = 1
+    results["n_expanded"] = 1
+    body = stats.tobytes() + results.tobytes()
+    if flags & wire.COMPRESSED:
+        body, packed = wire.compress(config.get("codec"), body)
+        if not packed:
+            flags &= ~wire.COMPRESSED
+    header = wire.HEADER.pack(wire.MAGIC_ANSWER, wire.VERSION, flags, len(results), did, chash)
+    return header + body
+
+
+def serve(fifo):
+    if not os.path.exists(fifo):
+        os.mkfifo(fifo)
+    while True:
+        with open(fifo) as f:
+            lines = f.read().splitlines()
+        # A writer may open and close the FIFO without writing anything
+        if len(lines) < 2:
+            continue
+        config = json.loads(lines[0])
+        qname, aname, _, *shm = lines[1].split()
+        reqs, head = read_queries(qname, config)
+        out = answer(reqs, config, head)
+        if shm:
+            with open(shm[0], "r+b") as f:
+                f.write(out)
+            out = f"{len(out)}\n".encode()
+        with open(aname, "wb") as f:
+            f.write(out)
+
+
+def main():
+    threads = [threading.Thread(target=serve, args=(fifo,), daemon=True) for fifo in argv[1:]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#
+# HDR-style latency histograms.
+# Values (e.g. nanoseconds) fall in log-linear buckets: exact below
+# 2**SUB_BITS, then 2**(SUB_BITS - 1) buckets per power of two, so every
+# value is known within 1 / 2**(SUB_BITS - 1) of its size. Histograms with the
+# same SUB_BITS add up bucket by bucket, so the histograms of separate
+# batches, workers or runs can be merged without the raw values.
+#
+# Usage: python histogram.py metrics.json [metrics.json ...]
+# merges the per-diff histograms of several runs and prints their percentiles.
+#
+import json
+from sys import argv
+
+import numpy as np
+
+
+SUB_BITS = 8
+HALF = 1 << (SUB_BITS - 1)
+# Enough buckets for any uint64 value
+NBUCKETS = (64 - SUB_BITS + 2) * HALF
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+def bucket(values):
+    """Bucket index of non-negative integer values"""
+    values = np.asarray(values, dtype=np.uint64)
+    _, bits = np.frexp(values.astype(np.float64))
+    shift = np.maximum(bits.astype(np.int64) - SUB_BITS, 0).astype(np.uint64)
+    return (shift * np.uint64(HALF) + (values >> shift)).astype(np.int64)
+
+
+def highest(idx):
+    """Largest value falling in bucket idx"""
+    idx = np.asarray(idx, dtype=np.int64)
+    shift = np.maximum(idx // HALF - 1, 0)
+    low = (idx - shift * HALF) << shift
+    return low + (1 << shift) - 1
+
+
+class Histogram:
+    def __init__(self, values=()):
+        self.counts = np.zeros(NBUCKETS, dtype=np.int64)
+        self.max = 0
+        self.record(values)
+
+    def record(self, values):
+        values = np.asarray(values)
+        if values.size == 0:
+            return
+        values = np.rint(np.maximum(values, 0)).astype(np.uint64)
+        self.counts += np.bincount(bucket(values), minlength=NBUCKETS)
+        self.max = max(self.max, int(values.max()))
+
+    def __iadd__(self, other):
+        self.counts += other.counts
+        self.max = max(self.max, other.max)
+        return self
+
+    def __add__(self, other):
+        res = Histogram()
+        res += self
+        res += other
+        return res
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def percentile(self, q):
+        """Smallest recorded value such that q% of the values are not above"""
+        total = self.count
+        if total == 0:
+            return 0
+        rank = max(1, int(np.ceil(total * q / 100)))
+        idx = int(np.searchsorted(np.cumsum(self.counts), rank))
+        return int(min(highest(idx), self.max))
+
+    def summary(self):
+        res = {f"p{q:g}": self.percentile(q) for q in PERCENTILES}
+        res["max"] = self.max
+        res["count"] = self.count
+        return res
+
+    def to_dict(self):
+        """Summary, with the non-empty buckets to merge it later"""
+        nz = np.flatnonzero(self.counts)
+        res = self.summary()
+        res["sub_bits"] = SUB_BITS
+        res["buckets"] = nz.tolist()
+        res["counts"] = self.counts[nz].tolist()
+        return res
+
+    @classmethod
+    def from_dict(cls, d):
+        assert d["sub_bits"] == SUB_BITS, "Cannot merge histograms of another precision"
+        hist = cls()
+        hist.counts[d["buckets"]] = d["counts"]
+        hist.max = d["max"]
+        return hist
+
+
+def main():
+    merged = []
+    for fname in argv[1:]:
+        with open(fname) as f:
+            diffs = json.load(f)["latency"]["diffs"]
+        for i, d in enumerate(diffs):
+            hist = Histogram.from_dict(d["batch"])
+            if i < len(merged):
+                merged[i] += hist
+            else:
+                merged.append(hist)
+
+    for i, hist in enumerate(merged):
+        print(i, hist.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,230 @@
 # This script is called at the head node
 # Call workers to create CPDs based on cluster config
+# Builds are launched in parallel, each in a tmux session on its worker, which
+# records its status in a file that is polled until every shard is built.
+# Failed builds are launched again.
+# A build leaves a manifest in its outdir, recording what the shard was built
+# from: shards whose manifest matches the current inputs are not rebuilt.
 
 
-from subprocess import getstatusoutput
+from cluster import partition_replicas
+import asyncio
 import json
+import time
+from asyncio.subprocess import PIPE, STDOUT
 from sys import argv
 import argparse
 
-def call_worker(wid, conf):
-    host       = conf['workers'][wid]
+import numpy as np
+
+
+# Written by the build on its worker: "running <start>" then
+# "done <exit status> <start> <end>", times in seconds since the epoch
+STATUS = "/tmp/make_cpd-{wid}.status"
+RUNNER = "/tmp/make_cpd-{wid}.sh"
+MANIFEST = "{outdir}/manifest-{wid}.json"
+BINARY = "./bin/make_cpd_auto"
+
+
+class Build:
+    """Build of a shard's CPD on one of its hosts"""
+
+    def __init__(self, wid, host):
+        self.wid = wid
+        self.host = host
+        self.attempts = 0
+        self.state = "pending"
+        # Manifest the shard will have once built
+        self.manifest = None
+        self.code = None
+        self.start = None
+        self.end = None
+
+    def __str__(self):
+        return f"worker-{self.wid}@{self.host}"
+
+
+async def remote(host, script, sem):
+    """Run a shell script on a host, return its exit status and output"""
+    async with sem:
+        proc = await asyncio.create_subprocess_exec(
+            "ssh", "-T", host, "bash -s", stdin=PIPE, stdout=PIPE, stderr=STDOUT
+        )
+        out, _ = await proc.communicate(script.encode())
+    return proc.returncode, out.decode().strip()
+
+
+def manifest(wid, conf, xy_hash, binary_hash):
+    return {
+        "xy_hash": xy_hash,
+        "partmethod": conf["partmethod"],
+        "partkey": conf["partkey"],
+        "maxworker": len(partition_replicas(conf)),
+        "workerid": wid,
+        "binary_hash": binary_hash,
+    }
+
+
+async def check(build, conf, sem):
+    """Whether the shard is already built from the current inputs"""
+    code, out = await remote(
+        build.host,
+        f"cd {conf['projectdir']} || exit 1\n"
+        f"set -o pipefail\n"
+        f"sha1sum {conf['xy_file']} {BINARY} | cut -d' ' -f1 || exit 1\n"
+        # No manifest yet is not an error
+        f"cat {MANIFEST.format(outdir=conf['outdir'], wid=build.wid)} 2>/dev/null || true\n",
+        sem,
+    )
+    lines = out.splitlines()
+    if code or len(lines) < 2:
+        print(f"{build}: cannot hash the inputs ({code}) {out}")
+        return False
+    build.manifest = manifest(build.wid, conf, lines[0], lines[1])
+    try:
+        return json.loads("\n".join(lines[2:])) == build.manifest
+    except ValueError:
+        return False
+
+
+def launch_script(wid, conf, shard_manifest=None):
+    replicas   = partition_replicas(conf)
     name       = f"worker-{wid}"
     xyfile     = conf["xy_file"]
     partmethod = conf["partmethod"]
     partkey    = conf["partkey"]
-    maxworker  = len(conf["workers"])
+    maxworker  = len(replicas)
     outdir     = conf["outdir"]
     projdir    = conf["projectdir"]
-    cd         = f"cd {projdir}"
-    makecpd    = f"./bin/make_cpd_auto --input {xyfile} --partmethod {partmethod} --partkey {partkey} --workerid {wid} --maxworker {maxworker} --outdir {outdir}"
-    cmd        = f"ssh {host} \"{cd}; tmux new -As {name} -d '{makecpd}'\""
-    print(cmd)
-    code, out = getstatusoutput(cmd)
+    status     = STATUS.format(wid=wid)
+    runner     = RUNNER.format(wid=wid)
+    mfile      = MANIFEST.format(outdir=outdir, wid=wid)
+    makecpd    = f"{BINARY} --input {xyfile} --partmethod {partmethod} --partkey {partkey} --workerid {wid} --maxworker {maxworker} --outdir {outdir}"
+    return (
+        f"cat > {runner} <<'RUNNER'\n"
+        f"start=$(date +%s)\n"
+        f"echo running $start > {status}\n"
+        f"cd {projdir} && rm -f {mfile} && {makecpd}\n"
+        f"code=$?\n"
+        + (
+            f"[ $code = 0 ] && cat > {mfile} <<'MANIFEST'\n"
+            f"{json.dumps(shard_manifest)}\n"
+            f"MANIFEST\n"
+            if shard_manifest is not None else ""
+        ) +
+        f"echo done $code $start $(date +%s) > {status}\n"
+        f"RUNNER\n"
+        f"tmux kill-session -t {name} 2>/dev/null\n"
+        f"echo launched > {status}\n"
+        f"tmux new -d -s {name} 'bash {runner}'\n"
+    )
+
+
+async def launch(build, conf, sem):
+    build.attempts += 1
+    code, out = await remote(build.host, launch_script(build.wid, conf, build.manifest), sem)
     if code:
-        print (code, out)
+        print(f"{build}: cannot launch ({code}) {out}")
+        build.state, build.code = "failed", code
+    else:
+        print(f"{build}: launched (attempt {build.attempts})")
+        build.state = "running"
+
+
+async def poll(build, sem):
+    """Update the state of a running build from its status file"""
+    name = f"worker-{build.wid}"
+    # Check the session first, so a build ending in between is seen as done
+    code, out = await remote(
+        build.host,
+        f"tmux has-session -t {name} 2>/dev/null && echo alive; cat {STATUS.format(wid=build.wid)}\n",
+        sem,
+    )
+    if code == 255:
+        print(f"{build}: cannot reach host")
+        return
+    lines = out.splitlines()
+    alive = lines[:1] == ["alive"]
+    fields = lines[-1].split() if lines else []
+    if fields[:1] == ["running"]:
+        build.start = int(fields[1])
+    if fields[:1] == ["done"]:
+        build.code, build.start, build.end = (int(x) for x in fields[1:4])
+        build.state = "done" if build.code == 0 else "failed"
+    elif not alive:
+        # The session ended without writing its exit status
+        build.state, build.code = "failed", -1
+
+
+async def watch(build, conf, sem, args):
+    """Launch a build and poll it until it is done, retrying failures"""
+    if await check(build, conf, sem) and not args.force:
+        print(f"{build}: up to date")
+        build.state = "current"
+        return
+    while True:
+        await launch(build, conf, sem)
+        while build.state == "running":
+            await asyncio.sleep(args.poll)
+            await poll(build, sem)
+        if build.state == "done" or build.attempts > args.retries:
+            break
+        print(f"{build}: failed with status {build.code}, retrying")
+    if build.state == "done":
+        print(f"{build}: built in {build.end - build.start}s")
+    else:
+        print(f"{build}: failed with status {build.code} after {build.attempts} attempts")
+
 
-def test(workerid):
+async def progress(builds, period):
+    """Print how many builds are in each state, periodically"""
+    t0 = time.time()
+    while True:
+        await asyncio.sleep(period)
+        states = [b.state for b in builds]
+        counts = ", ".join(f"{states.count(s)} {s}" for s in sorted(set(states)))
+        print(f"[{time.time() - t0:.0f}s] {counts}")
+
+
+async def build_all(wids, conf, args):
+    replicas = partition_replicas(conf)
+    builds = [Build(wid, host) for wid in wids for host in replicas[wid]]
+    sem = asyncio.Semaphore(args.parallel)
+    if args.no_wait:
+        async def launch_stale(b):
+            if args.force or not await check(b, conf, sem):
+                await launch(b, conf, sem)
+        await asyncio.gather(*(launch_stale(b) for b in builds))
+        return builds
+
+    reporter = asyncio.create_task(progress(builds, args.poll))
+    try:
+        # Completion barrier: every build is done or out of retries
+        await asyncio.gather(*(watch(b, conf, sem, args) for b in builds))
+    finally:
+        reporter.cancel()
+    return builds
+
+
+def summary(builds):
+    """Print the build time of every shard, return the number of failures"""
+    print("worker host attempts status seconds")
+    times = []
+    for b in sorted(builds, key=lambda b: (b.wid, b.host)):
+        secs = "" if b.end is None or b.start is None else b.end - b.start
+        if b.state == "done":
+            times.append(secs)
+        print(b.wid, b.host, b.attempts, b.state if b.code is None else b.code, secs)
+    if times:
+        print(f"build time: min {min(times)}s, median {np.median(times):.0f}s, "
+              f"max {max(times)}s")
+    failed = sum(b.state not in ("done", "current") for b in builds)
+    current = sum(b.state == "current" for b in builds)
+    print(f"{len(builds) - failed}/{len(builds)} shards built, {current} were up to date")
+    return failed
+
+
+def test(workerid, args):
     test_conf = {
       "nfs": "/tmp",
       "partmethod": "mod",
@@ -38,17 +238,23 @@ def test(workerid):
 
     maxworker = 100
     test_conf["workers"] = ["localhost" for i in range(maxworker)]
-    call_worker(workerid, test_conf)
+    builds = asyncio.run(build_all([workerid], test_conf, args))
+    summary(builds)
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", type=str, default="./example-cluster-conf.json", help="cluster config")
     parser.add_argument("-w", type=int, default=-1, help="specify the worker, -1 means run on all workers")
     parser.add_argument("-t", action='store_true',  help="call the testing function")
+    parser.add_argument("--parallel", type=int, default=16, help="maximum number of concurrent ssh connections")
+    parser.add_argument("--poll", type=float, default=30, help="seconds between two polls of the builds")
+    parser.add_argument("--retries", type=int, default=1, help="launch a failed build again this many times")
+    parser.add_argument("--no-wait", action="store_true", help="only launch the builds")
+    parser.add_argument("--force", action="store_true", help="rebuild shards that are up to date")
     args = parser.parse_args(argv[1:])
 
     if args.t:
-        test(0 if args.w == -1 else args.w)
+        test(0 if args.w == -1 else args.w, args)
         return
 
     conf_path = args.c
@@ -56,10 +262,13 @@ def main():
     cluster_conf = json.load(open(conf_path, "r"))
 
     if worker == -1:
-        for i in range(len(cluster_conf['workers'])):
-            call_worker(i, cluster_conf)
+        wids = range(len(partition_replicas(cluster_conf)))
     else:
-        call_worker(worker, cluster_conf)
+        wids = [worker]
+
+    builds = asyncio.run(build_all(wids, cluster_conf, args))
+    if not args.no_wait and summary(builds):
+        exit(1)
 
 
 if __name__ == "__main__":
@@ -1,31 +1,215 @@
 # This script is called at the head node
 # Call workers to start fifo based on cluster config
+# Workers are launched in parallel, each in a tmux session, and probed until
+# they are ready: the session marks its status file once fifo_auto has created
+# its FIFO, i.e., its CPD shard is loaded.
+# An optional warm-up batch then goes through the same path as real queries.
 
-from subprocess import getstatusoutput
+from cluster import partition_replicas
+from make_cpds import remote
+from partition import node_table, WID
+import asyncio
 import json
 import argparse
 from sys import argv
 
-def call_worker(wid, conf):
-    host       = conf['workers'][wid]
+import numpy as np
+
+
+FIFO = "/tmp/worker{wid}.fifo"
+# Written on the worker: "start <time>" when fifo_auto starts, "ready <time>"
+# once it serves its FIFO, "exit <status>" when it ends, in seconds since the
+# epoch
+STATUS = "/tmp/fifo-{wid}.status"
+RUNNER = "/tmp/fifo-{wid}.sh"
+
+
+class Worker:
+    """fifo_auto process of a shard on one of its hosts"""
+
+    def __init__(self, wid, host):
+        self.wid = wid
+        self.host = host
+        self.state = "pending"
+        # The session was already running, its load time is not this launch's
+        self.running = False
+        self.load_time = None
+
+    def __str__(self):
+        return f"fifo-{self.wid}@{self.host}"
+
+
+def launch_script(wid, conf):
+    replicas   = partition_replicas(conf)
     name       = f"fifo-{wid}"
     xyfile     = conf["xy_file"]
     partmethod = conf["partmethod"]
     partkey    = conf["partkey"]
-    maxworker  = len(conf["workers"])
+    maxworker  = len(replicas)
     outdir     = conf["outdir"]
     projdir    = conf["projectdir"]
     diff       = conf['diffs'][0]
-    cd         = f"cd {projdir}"
     alg        = "table-search"
+    status     = STATUS.format(wid=wid)
+    runner     = RUNNER.format(wid=wid)
+    fifo       = FIFO.format(wid=wid)
     makefifo   = f"./bin/fifo_auto --input {xyfile} {diff} --partmethod {partmethod} --partkey {partkey} --workerid {wid} --maxworker {maxworker} --outdir {outdir} --alg {alg}"
-    cmd        = f"ssh {host} \"{cd}; tmux new -As {name} -d '{makefifo}'\""
-    print(cmd)
-    code, out = getstatusoutput(cmd)
+    return (
+        f"cat > {runner} <<'RUNNER'\n"
+        f"echo start $(date +%s.%N) > {status}\n"
+        f"cd {projdir} || {{ echo exit 1 >> {status}; exit 1; }}\n"
+        # fifo_auto creates its FIFO once its shard is loaded
+        f"rm -f {fifo}\n"
+        f"{makefifo} &\n"
+        f"pid=$!\n"
+        f"while kill -0 $pid 2>/dev/null && [ ! -p {fifo} ]; do sleep 0.2; done\n"
+        f"[ -p {fifo} ] && echo ready $(date +%s.%N) >> {status}\n"
+        f"wait $pid\n"
+        f"echo exit $? >> {status}\n"
+        f"RUNNER\n"
+        # Leave a running worker alone
+        f"if tmux has-session -t {name} 2>/dev/null; then\n"
+        f"  echo running\n"
+        f"else\n"
+        f"  rm -f {status}\n"
+        f"  tmux new -d -s {name} 'bash {runner}'\n"
+        f"fi\n"
+    )
+
+
+def probe_script(wid):
+    """Prints alive if the session runs, then the worker's status file"""
+    return (
+        f"tmux has-session -t fifo-{wid} 2>/dev/null && echo alive\n"
+        f"cat {STATUS.format(wid=wid)} 2>/dev/null\n"
+        f"true\n"
+    )
+
+
+async def launch(worker, conf, sem):
+    code, out = await remote(worker.host, launch_script(worker.wid, conf), sem)
+    if code:
+        print(f"{worker}: cannot launch ({code}) {out}")
+        worker.state = "dead"
+    else:
+        worker.running = out.splitlines()[-1:] == ["running"]
+        worker.state = "loading"
+
+
+async def probe(worker, sem):
+    """Update the state of a worker, and its load time once ready"""
+    code, out = await remote(worker.host, probe_script(worker.wid), sem)
     if code:
-        print (code, out)
+        worker.state = "unreachable"
+        return
+    lines = out.splitlines()
+    fields = dict(l.split(None, 1) for l in lines if " " in l)
+    if "alive" not in lines or "exit" in fields:
+        # The session is gone: fifo_auto exited or was never started
+        worker.state = "dead"
+    elif "ready" in fields:
+        if "start" in fields and not worker.running:
+            worker.load_time = float(fields["ready"]) - float(fields["start"])
+        worker.state = "ready"
+    else:
+        worker.state = "loading"
+
+
+async def wait_ready(worker, sem, timeout, poll):
+    """Probe a worker until it is ready, dead, or the timeout expires"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        await probe(worker, sem)
+        if worker.state in ("ready", "dead"):
+            break
+        if loop.time() + poll > deadline:
+            worker.state = "timeout"
+            break
+        await asyncio.sleep(poll)
+    print(f"{worker}: {worker.state}"
+          + ("" if worker.load_time is None else f", loaded in {worker.load_time:.1f}s"))
+
+
+def warmup_queries(wid, nodenum, maxworker, partmethod, partkey, size, seed=0):
+    """Random queries whose targets belong to a worker"""
+    rng = np.random.default_rng(seed)
+    _, table = node_table(nodenum, maxworker, partmethod, partkey)
+    targets = np.flatnonzero(table[:, WID] == wid)
+    if len(targets) == 0:
+        return np.empty((0, 2), dtype=np.uint32)
+    reqs = np.column_stack([
+        rng.integers(0, nodenum, size), rng.choice(targets, size),
+    ])
+    return reqs.astype(np.uint32)
+
+
+async def warmup(workers, conf, size, timeout):
+    """Send a small batch to every ready worker, drop those that do not answer"""
+    # Imported here, the driver parses its own options on import
+    import process_query
+    from args import parser as driver_parser
+
+    driver_args = driver_parser.parse_args(["--timeout", str(timeout)])
+    config = process_query.worker_config(driver_args)
+    nodenum = process_query.get_node_num(conf["xy_file"])
+    maxworker = len(partition_replicas(conf))
+
+    async def warm(worker, channels):
+        reqs = warmup_queries(worker.wid, nodenum, maxworker, conf["partmethod"],
+                              conf["partkey"], size)
+        row = await process_query.send_queries(
+            worker.host, worker.wid, conf["nfs"], config, conf["diffs"][0], reqs, channels
+        )
+        if len(row) <= 3:
+            print(f"{worker}: no answer to the warm-up batch")
+            worker.state = "cold"
+        else:
+            print(f"{worker}: warmed up in {row[-2] / 1e9:.2f}s")
 
-def test(workerid):
+    async with process_query.make_channels(driver_args) as channels:
+        await asyncio.gather(*(warm(w, channels) for w in workers if w.state == "ready"))
+
+
+async def wait_fleet(wids, replicas, timeout, poll=1, parallel=16):
+    """Workers of every replica of the shards wids, once probed until ready"""
+    sem = asyncio.Semaphore(parallel)
+    workers = [Worker(wid, host) for wid, hosts in zip(wids, replicas) for host in hosts]
+    await asyncio.gather(*(wait_ready(w, sem, timeout, poll) for w in workers))
+    return workers
+
+
+async def start_fleet(wids, conf, args):
+    replicas = partition_replicas(conf)
+    sem = asyncio.Semaphore(args.parallel)
+    workers = [Worker(wid, host) for wid in wids for host in replicas[wid]]
+    await asyncio.gather(*(launch(w, conf, sem) for w in workers))
+    if args.no_wait:
+        return workers
+    await asyncio.gather(*(
+        wait_ready(w, sem, args.timeout, args.poll) for w in workers if w.state != "dead"
+    ))
+    if args.warmup > 0:
+        await warmup(workers, conf, args.warmup, args.timeout)
+    return workers
+
+
+def summary(workers):
+    """Print the load time of every worker, return the number not ready"""
+    print("worker host state load_time")
+    loads = []
+    for w in sorted(workers, key=lambda w: (w.wid, w.host)):
+        print(w.wid, w.host, w.state, "" if w.load_time is None else f"{w.load_time:.1f}")
+        if w.load_time is not None:
+            loads.append(w.load_time)
+    if loads:
+        print(f"load time: min {min(loads):.1f}s, median {np.median(loads):.1f}s, "
+              f"max {max(loads):.1f}s")
+    failed = sum(w.state != "ready" for w in workers)
+    print(f"{len(workers) - failed}/{len(workers)} workers ready")
+    return failed
+
+def test(workerid, args):
     test_conf = {
       "nfs": "/tmp",
       "partmethod": "mod",
@@ -39,17 +223,22 @@ def test(workerid):
 
     maxworker = 100
     test_conf["workers"] = ["localhost" for i in range(maxworker)]
-    call_worker(workerid, test_conf)
+    summary(asyncio.run(start_fleet([workerid], test_conf, args)))
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", type=str, default="./example-cluster-conf.json", help="cluster config")
     parser.add_argument("-w", type=int, default=-1, help="specify the worker, -1 means run on all workers")
     parser.add_argument("-t", action='store_true',  help="call the testing function")
+    parser.add_argument("--parallel", type=int, default=16, help="maximum number of concurrent ssh connections")
+    parser.add_argument("--poll", type=float, default=1, help="seconds between two probes of a worker")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for a worker to be ready")
+    parser.add_argument("--warmup", type=int, default=0, help="size of a warm-up batch sent to every worker")
+    parser.add_argument("--no-wait", action="store_true", help="only launch the workers")
     args = parser.parse_args(argv[1:])
 
     if args.t:
-        test(0 if args.w == -1 else args.w)
+        test(0 if args.w == -1 else args.w, args)
         return
 
     conf_path = args.c
@@ -57,10 +246,13 @@ def main():
     cluster_conf = json.load(open(conf_path, "r"))
 
     if worker == -1:
-        for i in range(len(cluster_conf['workers'])):
-            call_worker(i, cluster_conf)
+        wids = range(len(partition_replicas(cluster_conf)))
     else:
-        call_worker(worker, cluster_conf)
+        wids = [worker]
+
+    workers = asyncio.run(start_fleet(wids, cluster_conf, args))
+    if not args.no_wait and summary(workers):
+        exit(1)
 
 if __name__ == "__main__":
     main()
@@ -3,121 +3,98 @@
 #
 from timer import Timer
 from args import args, process_filename, get_time_ns
+from scenario import read_p2p, pair_keys
+from partition import group_by
+from channel import Channels, send_fifo
 #  import tools.reader as reader
 
 import os
 import stat
-from os.path import join, isdir
+from os.path import join, isdir, splitext
 import json
 import csv
-from multiprocessing.dummy import Pool
-from itertools import cycle
-from subprocess import getstatusoutput
+import asyncio
 from collections import defaultdict
 
+import numpy as np
+
 
 fifo = "/tmp/warthog.fifo"
 answer = "/tmp/warthog.answer"
 
 
-def read_p2p(sce_name):
-    """Read a point-to-point scenario file"""
-    reqs = []
-
-    with open(sce_name) as f:
-        for line in f:
-            if not line.strip() or line[0] != "q":
-                continue
-            reqs.append([int(x) for x in line.split()[1:]])
-
-    return reqs
-
-
 def make_parts(reqs, which, num_parts, size_parts):
+    """Split the (N, 2) query array into num_parts arrays"""
     if which == "all":
         # Group queries per destination, then partition
-        groups = defaultdict(list)
-        for (x, y) in reqs:
-            groups[y].append([x, y])
-
-        parts = [[] for _ in range(num_parts)]
-        i = 0
-        for v in groups.values():
-            parts[i].extend(v)
-
-            if len(parts[i]) > size_parts:
-                i += 1
+        _, inverse, counts = np.unique(
+            reqs[:, 1], return_inverse=True, return_counts=True
+        )
+        grouped = reqs[np.argsort(inverse, kind="stable")]
+
+        bounds = []
+        size = 0
+        for c in np.cumsum(counts):
+            if c - size > size_parts:
+                bounds.append(c)
+                size = c
+        parts = np.split(grouped, bounds)
+        parts += [grouped[:0]] * (num_parts - len(parts))
     elif which == "mod" or which == "div" or which == "alloc":
-        parts = [[] for _ in range(num_parts)]
-
-        for (x, y) in reqs:
-            if which == "mod":
-                key = y % size_parts
-            elif which == "div":
-                key = y // size_parts
-            elif which == "alloc":
-                key = next(i for i, val in enumerate(size_parts) if val > y)
-            else:
-                raise ValueError(f"Unknown alloc scheme '{which}'")
-
-            parts[key].append([x, y])
+        y = reqs[:, 1]
+        if which == "mod":
+            keys = y % size_parts
+        elif which == "div":
+            keys = y // size_parts
+        elif which == "alloc":
+            # First range whose upper bound is above the target
+            keys = np.searchsorted(size_parts, y, side="right")
+            assert not len(y) or keys.max() < num_parts, "Target beyond the last --alloc bound"
+        else:
+            raise ValueError(f"Unknown alloc scheme '{which}'")
+
+        parts = [reqs[idx] for idx in group_by(keys, num_parts)]
     else:
         parts = [reqs[size_parts * i : size_parts * (i + 1)] for i in range(num_parts)]
 
     return parts
 
 
-def send_local(qname, config):
-    with open(fifo, "w") as f:
-        f.write(config)
+def fifo_pair(slot):
+    """FIFO and answer pipe of the `slot`-th partition sent to a host"""
+    if slot == 0:
+        return fifo, answer
+    return tuple(f"{root}.{slot}{ext}" for root, ext in map(splitext, (fifo, answer)))
 
-    out = ""
-    os.mkfifo(answer)
-    with open(answer, "r") as f:
-        for line in f:
-            out = line.strip()  # Should be a single line
 
-    os.remove(answer)
+def write_queries(qname, reqs):
+    """Write a query file for the resident process"""
+    with open(qname, "w") as f:
+        f.write(f"{len(reqs)}\n")
+        np.savetxt(f, reqs, fmt="%d")
 
-    return 0, out
 
-
-def send_remote(hostname, fname, qname, config):
-    with open(fname, "w") as f:
-        f.write(f"mkfifo {answer}\n")
-        f.write(f"cat <<CONF > {fifo}\n")  # HEREDOC
-        f.write(config)
-        f.write("CONF\n")  # HEREDOC
-        f.write(f"cat {answer}\n")
-        f.write(f"rm {answer}")
-
-    return getstatusoutput(f"ssh {hostname} 'bash -s' < {fname}")
-
-
-def send_queries(hostname, nfs, config, dname, reqs):
-    fname = f"query.{hostname}"
+async def send_queries(hostname, slot, nfs, config, dname, reqs, channels):
+    fname = f"query.{hostname}.{slot}"
     qname = join(nfs, fname)  # Query files need to be unique
     nb_reqs = len(reqs)
+    fifo, answer = fifo_pair(slot)
     # Runtime configuration for the resident process(es)
     conf = json.dumps(config) + "\n" + "{} {} {}\n".format(qname, answer, dname)
 
     with Timer() as t_prepare:
-        with open(qname, "w") as f:
-            f.write(f"{nb_reqs}\n")
-            f.writelines("{} {}\n".format(*x) for x in reqs)
+        await asyncio.to_thread(write_queries, qname, reqs)
 
     print(f"Processing {nb_reqs} queries on '{hostname}'")
     with Timer() as t_partition:
         if hostname == "localhost":
-            code, out = send_local(qname, conf)
+            code, out = await send_fifo(fifo, answer, conf, channels.timeout)
         else:
-            code, out = send_remote(hostname, fname, qname, conf)
+            code, out = await channels.get(hostname, fifo, answer).send(conf)
 
     if code == 0:
         res = out.split(",")
         os.remove(qname)
-        if hostname != "localhost":
-            os.remove(fname)
     else:
         print(code, out)
         res = ""
@@ -125,17 +102,26 @@ def send_queries(hostname, nfs, config, dname, reqs):
     return (*res, t_prepare.interval * 1e9, t_partition.interval * 1e9, len(reqs))
 
 
-def read_p2p(sce_name):
-    """Read a point-to-point scenario file"""
-    reqs = []
+async def send_diffs(hostname, slot, nfs, config, diffs, reqs, channels):
+    """Send a partition once per diff, without waiting for the other partitions"""
+    return [
+        await send_queries(hostname, slot, nfs, config, dname, reqs, channels)
+        for dname in diffs
+    ]
+
 
-    with open(sce_name) as f:
-        for line in f:
-            if not line.strip() or line[0] != 'q':
-                continue
-            reqs.append([int(x) for x in line.split()[1:]])
+async def dispatch(workload, args):
+    """Send every partition concurrently from the event loop"""
+    channels = Channels(
+        timeout=args.timeout or None,
+        connect_limit=args.connect_limit,
+        host_limit=args.host_limit,
+    )
+    async with channels:
+        results = await asyncio.gather(*(send_diffs(*w, channels) for w in workload))
+    # Run one experiment per diff
+    return [list(expe) for expe in zip(*results)]
 
-    return reqs
 
 def main(args):
     sce_name = process_filename(args.scenario)
@@ -173,10 +159,6 @@ def main(args):
         mod = args.mod
         alloc = args.alloc
 
-    assert num_parts <= len(
-        hosts
-    ), "Currently only works with max 1 partition per worker."
-
     # Config passed to warthog threads
     conf = {
         "hscale": args.h_scale,
@@ -201,38 +183,38 @@ def main(args):
                 len(parts) == num_parts
             ), "Can only use --div to produce as many parts as hosts"
         elif mod is not None:
-            assert mod == len(hosts), "Can only use --mod with the same number of hosts"
+            assert mod % len(hosts) == 0, "Can only use --mod with a multiple of the number of hosts"
 
             num_parts = args.mod
             parts = make_parts(reqs, "mod", num_parts, mod)
             assert not any(len(x) == 0 for x in parts)
         elif alloc is not None:
-            assert len(alloc) == len(
-                hosts
-            ), "Can only use --alloc with the same number of hosts"
+            assert (
+                len(alloc) % len(hosts) == 0
+            ), "Can only use --alloc with a multiple of the number of hosts"
             num_parts = len(alloc)
             parts = make_parts(reqs, "alloc", num_parts, alloc)
         else:
             size_parts = (total_qs // num_parts) + 1  # We want inclusive partitions
             parts = make_parts(reqs, args.group, num_parts, size_parts)
 
-        if args.sort:
-            for l in parts:
-                l.sort(key=lambda x: x[1])
+        order = "target" if args.sort else args.batch_order
+        assert order in ("none", "target"), f"--batch-order {order} needs process_query.py"
+        if order == "target":
+            parts = [l[np.argsort(pair_keys(l[:, ::-1]), kind="stable")] for l in parts]
 
     with Timer() as p:
-        stats = []
-        # Run one experiment per diff
-        for i, dname in enumerate(args.diffs):
-            workload = zip(hosts, cycle([nfs]), cycle([conf]), cycle([dname]), parts)
-
-            with Pool(num_parts) as pool:  # number of workers is important
-                results = [
-                    pool.apply_async(send_queries, w)
-                    for w in workload
-                    if len(w[-1]) > 0
-                ]
-                stats.append([r.get() for r in results])
+        # Partitions are dealt to hosts in turn, each on its own FIFO pair:
+        # slots are numbered per host name, which may be listed several times
+        slots = defaultdict(int)
+        workload = []
+        for k, part in enumerate(parts):
+            host = hosts[k % len(hosts)]
+            slot = slots[host]
+            slots[host] += 1
+            if len(part) > 0:
+                workload.append((host, slot, nfs, conf, args.diffs, part))
+        stats = asyncio.run(dispatch(workload, args))
 
     data = {
         "num_queries": total_qs,
@@ -284,7 +266,9 @@ def main(args):
         with open(join(dirname, "parts.csv"), "w") as f:
             writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
             writer.writerow(header)
-            writer.writerows([[i] + row for i, row in stats])
+            writer.writerows(
+                [[i, *row] for i, expe in enumerate(stats) for row in expe]
+            )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,90 @@
+#
+# Order of the queries within each partition before they are sent.
+# Queries searched one after the other on a worker share more of its runtime
+# cache when they touch the same part of the CPD or of the map:
+#   - target:  by target, then source
+#   - block:   by the CPD block (bid, bidx) of the target
+#   - hilbert: along a Hilbert curve over the source's coordinates
+# Every strategy computes one uint64 key per query, partitions are then
+# sorted on their keys with a stable argsort.
+#
+import numpy as np
+
+from partition import BID, BIDX
+from scenario import pair_keys
+
+
+ORDERS = ["none", "target", "block", "hilbert"]
+
+# Side of the Hilbert grid is 2**HILBERT_BITS cells
+HILBERT_BITS = 16
+
+# Read the .xy file this many bytes at a time
+CHUNK_BYTES = 1 << 26
+
+
+def read_coords(xy_file, nodenum, chunk_bytes=CHUNK_BYTES):
+    """(nodenum, 2) array of the coordinates of the 'v id x y' lines"""
+    coords = np.zeros((nodenum, 2), dtype=np.float64)
+    with open(xy_file) as f:
+        while True:
+            lines = f.readlines(chunk_bytes)
+            if not lines:
+                break
+            text = " ".join(l[1:] for l in lines if l.startswith("v "))
+            rows = np.fromstring(text, dtype=np.float64, sep=" ").reshape(-1, 3)
+            coords[rows[:, 0].astype(np.int64)] = rows[:, 1:]
+    return coords
+
+
+def hilbert_keys(x, y, bits=HILBERT_BITS):
+    """Distance along the Hilbert curve of integer cells (x, y) of the grid"""
+    n = np.uint64(1 << bits)
+    x = x.astype(np.uint64)
+    y = y.astype(np.uint64)
+    d = np.zeros(len(x), dtype=np.uint64)
+    s = n >> np.uint64(1)
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((np.uint64(3) * rx) ^ ry).astype(np.uint64)
+        # Rotate the quadrant so the curve stays continuous
+        flip = ~ry & rx
+        x = np.where(flip, n - np.uint64(1) - x, x)
+        y = np.where(flip, n - np.uint64(1) - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= np.uint64(1)
+    return d
+
+
+def grid(coords, bits=HILBERT_BITS):
+    """Scale coordinates to the integer cells of the Hilbert grid"""
+    lo = coords.min(axis=0)
+    span = np.maximum(coords.max(axis=0) - lo, np.finfo(np.float64).tiny)
+    cells = (coords - lo) / span * ((1 << bits) - 1)
+    return np.rint(cells).astype(np.uint64)
+
+
+def order_keys(order, reqs, table=None, coords=None):
+    """Sort key of every query for an ordering strategy, None keeps the order"""
+    if order == "none":
+        return None
+    if order == "target":
+        return pair_keys(reqs[:, ::-1])
+    if order == "block":
+        assert table is not None, "Ordering by block needs the node table"
+        bids = table[reqs[:, 1], BID].astype(np.uint64)
+        bidx = table[reqs[:, 1], BIDX].astype(np.uint64)
+        return (bids << np.uint64(32)) | bidx
+    if order == "hilbert":
+        assert coords is not None, "Ordering along a Hilbert curve needs coordinates"
+        cells = grid(coords)[reqs[:, 0]]
+        return hilbert_keys(cells[:, 0], cells[:, 1])
+    raise ValueError(f"Unknown order '{order}'")
+
+
+def order_parts(parts, keys):
+    """Sort index arrays of the queries on their keys"""
+    if keys is None:
+        return parts
+    return [part[np.argsort(keys[part], kind="stable")] for part in parts]
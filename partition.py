@@ -0,0 +1,107 @@
+#
+# Node distribution computed on the head node.
+# Mirrors ./bin/gen_distribute_conf (see distribution_controller.h) for the
+# `mod` and `div` methods and caches the resulting table on disk.
+#
+import os
+from os.path import join, isfile
+from subprocess import getstatusoutput
+
+import numpy as np
+
+
+CACHE_DIR = "./cache"
+
+# Columns of the node table
+WID, BID, BIDX = 0, 1, 2
+
+
+def cache_name(nodenum, maxworker, partmethod, partkey, cache_dir=CACHE_DIR):
+    return join(cache_dir, f"dist-{nodenum}-{maxworker}-{partmethod}-{partkey}.npy")
+
+
+def distribute(nodenum, maxworker, partmethod, partkey):
+    """
+    Compute the (nodenum, 3) table of (worker id, block id, index in block)
+    for every node, or None if the method is only known to the binary.
+    """
+    nodes = np.arange(nodenum, dtype=np.int64)
+    partkey = int(partkey)
+
+    if partmethod == "mod":
+        bid = nodes % partkey
+        bidx = nodes // partkey
+    elif partmethod == "div":
+        bid = nodes // partkey
+        bidx = nodes % partkey
+    else:
+        return None
+
+    return np.stack([bid % maxworker, bid, bidx], axis=1).astype(np.int32)
+
+
+def from_binary(nodenum, maxworker, partmethod, partkey):
+    """Run ./bin/gen_distribute_conf and parse its output into a node table"""
+    cmd = f"./bin/gen_distribute_conf --nodenum {nodenum} --maxworker {maxworker} --partmethod {partmethod} --partkey {partkey}"
+    code, out = getstatusoutput(cmd)
+    if code:
+        return code, out
+
+    # Skip the header, one `node,wid,bid,bidx` line per node
+    body = out.split("\n", 1)[1].replace("\n", ",")
+    rows = np.fromstring(body, dtype=np.int64, sep=",").reshape(-1, 4)
+    table = np.zeros((nodenum, 3), dtype=np.int32)
+    table[rows[:, 0]] = rows[:, 1:]
+
+    return code, table
+
+
+def mismatches(table, ref):
+    """Nodes whose assignment differs between two node tables"""
+    return np.flatnonzero((table != ref).any(axis=1))
+
+
+def node_table(nodenum, maxworker, partmethod, partkey, verify=False,
+               cache_dir=CACHE_DIR):
+    """
+    Get the node table for a distribution, from the cache if possible.
+    Returns (code, table), or (code, message) when the binary fails.
+    """
+    cname = cache_name(nodenum, maxworker, partmethod, partkey, cache_dir)
+    if isfile(cname) and not verify:
+        return 0, np.load(cname, mmap_mode="r")
+
+    table = distribute(nodenum, maxworker, partmethod, partkey)
+    if table is None:
+        code, table = from_binary(nodenum, maxworker, partmethod, partkey)
+    elif verify:
+        code, ref = from_binary(nodenum, maxworker, partmethod, partkey)
+        if code:
+            print(f"Cannot check the distribution: {ref}")
+        else:
+            bad = mismatches(table, ref)
+            if len(bad):
+                # Trust the binary over our own copy when they disagree
+                print(f"{len(bad)} nodes differ from gen_distribute_conf, first: {bad[0]}")
+                table = ref
+        code = 0
+    else:
+        code = 0
+
+    if code:
+        return code, table
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{cname}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, table)
+    os.replace(tmp, cname)
+
+    return code, table
+
+
+def group_by(keys, nparts):
+    """Indices grouped by key value, one array per part in [0, nparts)"""
+    order = np.argsort(keys, kind="stable")
+    bounds = np.cumsum(np.bincount(keys, minlength=nparts))[:-1]
+    return np.split(order, bounds)
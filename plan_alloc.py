@@ -0,0 +1,86 @@
+# This script is called at the head node
+# Plan --alloc node ranges that balance the predicted work of each worker
+
+
+import argparse
+import csv
+import json
+from sys import argv
+
+import numpy as np
+
+from scenario import read_p2p
+
+
+def read_costs(parts_csv, metric, expe=0):
+    """Per-query cost of each worker in an experiment of a previous parts.csv"""
+    with open(parts_csv) as f:
+        rows = [r for r in csv.DictReader(f) if int(r["expe"]) == expe]
+    return np.array([float(r[metric]) / max(1.0, float(r["size"])) for r in rows])
+
+
+def node_weights(reqs, nodenum, prev_alloc=None, costs=None):
+    """
+    Predicted work per target node: the number of queries to each target,
+    scaled by the per-query cost of the worker that served it before.
+    """
+    weights = np.bincount(reqs[:, 1], minlength=nodenum).astype(np.float64)
+    if costs is not None:
+        assert len(costs) == len(prev_alloc), "Need one parts.csv row per range"
+        owner = np.searchsorted(prev_alloc, np.arange(len(weights)), side="right")
+        owner = np.minimum(owner, len(costs) - 1)
+        weights *= costs[owner]
+    return weights
+
+
+def plan(weights, nworkers):
+    """Upper bounds of nworkers node ranges with the same total weight"""
+    cum = np.cumsum(weights)
+    goals = cum[-1] * np.arange(1, nworkers) / nworkers
+    # Cut before or after the node reaching each goal, whichever is closer
+    idx = np.searchsorted(cum, goals, side="left")
+    before = np.where(idx > 0, cum[idx - 1], 0)
+    bounds = np.where(goals - before < cum[idx] - goals, idx, idx + 1)
+    bounds = np.maximum.accumulate(bounds)
+    return [int(b) for b in bounds] + [len(weights)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenario", type=str, help="scenario file")
+    parser.add_argument("-n", type=int, required=True, help="number of workers")
+    parser.add_argument("--nodenum", type=int, default=0,
+            help="number of nodes, default is the largest target + 1")
+    parser.add_argument("--parts", type=str, help="parts.csv of a previous run")
+    parser.add_argument("--prev-alloc", type=int, nargs="+",
+            help="--alloc ranges used by the run in --parts")
+    parser.add_argument("--metric", type=str, default="t_search",
+            choices=["t_search", "n_expanded"], help="cost read from --parts")
+    parser.add_argument("--expe", type=int, default=0, help="experiment (diff) to read from --parts")
+    parser.add_argument("-o", type=str, help="write the ranges to this JSON file")
+    args = parser.parse_args(argv[1:])
+
+    reqs = read_p2p(args.scenario)
+    nodenum = max(args.nodenum, int(reqs[:, 1].max()) + 1 if len(reqs) else 0)
+
+    costs = None
+    if args.parts is not None:
+        assert args.prev_alloc is not None, "--parts needs --prev-alloc"
+        costs = read_costs(args.parts, args.metric, args.expe)
+
+    weights = node_weights(reqs, nodenum, args.prev_alloc, costs)
+    alloc = plan(weights, args.n)
+
+    cum = np.concatenate([[0], np.cumsum(weights)])
+    loads = np.diff(cum[alloc], prepend=0)
+    for i, (b, l) in enumerate(zip(alloc, loads)):
+        print(f"worker {i}: nodes < {b}, predicted load {l:.1f}")
+    print("--alloc", *alloc)
+
+    if args.o is not None:
+        with open(args.o, "w") as f:
+            json.dump({"alloc": alloc}, f)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,125 +3,570 @@
 # Pass data directly to FIFOs
 #
 from timer import Timer
+from tracing import Span
+import tracing
 from args import args, process_filename, get_time_ns
+from scenario import read_p2p, dedup
+from partition import node_table, group_by, WID
+from channel import Channels
+from cluster import partition_replicas
+from make_fifos import wait_fleet
+from ordering import order_keys, order_parts, read_coords
+from resultcache import ResultCache, file_hash, search_hash
+from results import ResultStore
+from spill import SpillFile, spill_p2p
+from histogram import Histogram
+from codec import resolve
+import shm
+import wire
 
 import os
 import stat
 from os.path import join, isdir
 import json
 import csv
-from multiprocessing.dummy import Pool
-from itertools import cycle
-from subprocess import getstatusoutput
+import asyncio
+from contextlib import aclosing
 from collections import defaultdict
 
+import numpy as np
 
-node2worker = {}
 
-
-def read_p2p(sce_name):
-    """Read a point-to-point scenario file"""
-    reqs = []
-
-    with open(sce_name) as f:
-        for line in f:
-            if not line.strip() or line[0] != "q":
-                continue
-            reqs.append([int(x) for x in line.split()[1:]])
-
-    return reqs
-
-
-def make_parts(reqs, nodenum, maxworker, partmethod, partkey, activew):
+def make_parts(reqs, nodenum, maxworker, partmethod, partkey, activew, verify=False):
     """
-        assign peuries to each worker, based on result from distribute controller
+        assign queries to each worker, based on the node distribution table
+        reqs is the (N, 2) array returned by read_p2p
         return [
-                [(s1, t1), (s2, t2), ...], // queries for worker 0
+                [i1, i2, ...], // indices in reqs of the queries for worker 0
                 [...], // queries for worker 1 
                 ...
         ]
         where targets are in the assigned worker
     """
-
-    cmd = f"./bin/gen_distribute_conf --nodenum {nodenum} --maxworker {maxworker} --partmethod {partmethod} --partkey {partkey}"
-    code, out = getstatusoutput(cmd)
+    code, table = node_table(nodenum, maxworker, partmethod, partkey, verify)
     if code:
-        return code, out
-    lines = out.split('\n')[1:]
-    for l in lines:
-        node, wid, bid, bidx = map(int, l.split(','))
-        node2worker[node] = wid
-    groups = defaultdict(list)
-    worker = {}
-    for s, t in reqs:
-        wid = node2worker[t]
-        assert(wid is not None)
-        if activew == -1 or wid == activew:
-            groups[wid].append([s, t])
-
-    parts = [groups[i] for i in range(maxworker) if groups.get(i) is not None]
+        return code, table
+
+    wids = table[reqs[:, 1], WID]
+    if activew == -1:
+        parts = group_by(wids, maxworker)
+    else:
+        parts = [np.flatnonzero(wids == activew)]
     return code, parts
 
 
-def send_remote(hostname, fname, qname, config, answer=None, fifo=None):
-    if answer is None:
-        answer = "/tmp/warthog.answer"
-    if fifo is None:
-        fifo = "/tmp/warthog.fifo"
-    with open(fname, "w") as f:
-        f.write(f"mkfifo {answer}\n")
-        f.write(f"cat <<CONF > {fifo}\n")  # HEREDOC
-        f.write(config)
-        f.write("CONF\n")  # HEREDOC
-        f.write(f"cat {answer}\n")
-        f.write(f"rm {answer}")
+def write_queries(qname, reqs, config, dname):
+    """Write a query file for the resident process, in its wire format"""
+    with Span("write", "io", file=qname, size=len(reqs)):
+        if config.get("wire") == "binary":
+            flags = wire.PER_QUERY if config.get("per_query") else 0
+            with open(qname, "wb") as f:
+                wire.write_queries(f, reqs, wire.diff_id(dname), wire.config_hash(config), flags,
+                                   config.get("codec"))
+        else:
+            with open(qname, "w") as f:
+                f.write(f"{len(reqs)}\n")
+                np.savetxt(f, reqs, fmt="%d")
 
-    return getstatusoutput(f"ssh {hostname} 'bash -s' < {fname}")
 
+def parse_answer(out, config, dname):
+    """
+    Statistics of a batch from the resident process' answer, and its
+    per-query results if they were asked for (None otherwise)
+    """
+    with Span("parse"):
+        if config.get("wire") == "binary":
+            stats, results = wire.read_answers(out, wire.diff_id(dname), wire.config_hash(config),
+                                               config.get("codec"))
+            return list(stats.tolist()), results
+        res = out.split(",")
+        # An empty or cut-off answer is a failed batch, not a row
+        if len(res) != len(wire.ANSWER.names):
+            raise ValueError(f"{len(res)} fields in '{out}', expected {len(wire.ANSWER.names)}")
+        for x in res:
+            float(x)
+        return res, None
 
-def send_queries(hostname, workerid, nfs, config, dname, reqs):
-    fname = f"query.{hostname}{workerid}"
-    qname = join(nfs, fname)  # Query files need to be unique
-    nb_reqs = len(reqs)
-    fifo  = f"/tmp/worker{workerid}.fifo"
-    answer = f"/tmp/worker{workerid}.answer"
+
+def merge_answers(answers):
+    """Sum the counters and timers of several answers"""
+    rows = [[float(x) for x in res] for res in answers]
+    return [sum(col) for col in zip(*rows)]
+
+
+async def send_queries(hostname, workerid, nfs, config, dname, reqs, channels, chunk_size=0,
+                       sink=None, qfile=None):
+    """
+    Send a batch to a worker and return its row of statistics. Per-query
+    results, if any, are passed to `sink`. A query file already written, e.g.
+    a SpillFile, is sent as is with `qfile` instead of `reqs`.
+    """
+    if chunk_size > 0:
+        return await stream_queries(
+            hostname, workerid, nfs, config, dname, reqs, channels, chunk_size, sink
+        )
+
+    fifo, answer = channels.fifo_pair(workerid)
+    local = channels.local(hostname, fifo, answer) if qfile is None else None
+    if local is not None:
+        return await send_local(hostname, workerid, config, dname, reqs, local, sink)
+
+    if qfile is None:
+        fname = f"query.{hostname}{workerid}"
+        qname = join(nfs, fname)  # Query files need to be unique
+        nb_reqs = len(reqs)
+    else:
+        qname, nb_reqs = qfile.name, len(qfile)
     # Runtime configuration for the resident process(es)
     conf = json.dumps(config) + "\n" + "{} {} {}\n".format(qname, answer, dname)
 
     print(f"sending {nb_reqs} to {hostname}, conf:\n", conf)
 
-    with Timer() as t_prepare:
-        with open(qname, "w") as f:
-            f.write(f"{nb_reqs}\n")
-            f.writelines("{} {}\n".format(*x) for x in reqs)
+    with Span("prepare", worker=workerid, size=nb_reqs) as t_prepare:
+        if qfile is None:
+            await asyncio.to_thread(write_queries, qname, reqs, config, dname)
 
     print(f"Processing {nb_reqs} queries on '{hostname}'")
-    with Timer() as t_partition:
-        code, out = send_remote(hostname, fname, qname, conf, answer, fifo)
+    with Span("partition", host=hostname, worker=workerid, size=nb_reqs) as t_partition:
+        code, out = await channels.get(hostname, fifo, answer).send(conf)
 
+    res = ""
     if code == 0:
-        res = out.split(",")
-        os.remove(qname)
-        if hostname != "localhost":
-            os.remove(fname)
+        try:
+            res, results = parse_answer(out, config, dname)
+            if results is not None and sink is not None:
+                sink(results)
+            # Spill files are shared by the replicas and the diffs
+            if qfile is None:
+                os.remove(qname)
+        except ValueError as e:
+            print(f"Bad answer from '{hostname}': {e}")
     else:
         print(code, out)
-        res = ""
 
-    return (*res, t_prepare.interval * 1e9, t_partition.interval * 1e9, len(reqs))
+    return (*res, t_prepare.interval * 1e9, t_partition.interval * 1e9, nb_reqs)
+
+
+async def send_local(hostname, workerid, config, dname, reqs, channel, sink=None):
+    """
+    Send a batch to a worker of this host through shared memory: the query
+    file and the answer are segments in /dev/shm, whose paths go with the
+    runtime configuration, and the answer pipe only carries the size of the
+    answer.
+    """
+    nb_reqs = len(reqs)
+    flags = wire.PER_QUERY if config.get("per_query") else 0
+    print(f"Processing {nb_reqs} queries on '{hostname}' through shared memory")
+    with Span("prepare", worker=workerid, size=nb_reqs) as t_prepare:
+        query = shm.query_segment(reqs, wire.diff_id(dname), wire.config_hash(config), flags)
+        answer = shm.Segment(shm.answer_size(nb_reqs, flags))
+
+    res = ""
+    try:
+        conf = json.dumps(config) + "\n" + "{} {} {} {}\n".format(
+            query.path, channel.answer, dname, answer.path
+        )
+        with Span("partition", host=hostname, worker=workerid, size=nb_reqs) as t_partition:
+            code, out = await channel.send(conf)
+        if code == 0:
+            try:
+                # Parsed from a copy: the sink may keep the results, and the
+                # segment is closed below
+                res, results = parse_answer(answer.read(int(out)), config, dname)
+                if results is not None and sink is not None:
+                    sink(results)
+            except ValueError as e:
+                print(f"Bad answer from '{hostname}': {e}")
+        else:
+            print(code, out)
+    finally:
+        query.close()
+        answer.close()
+
+    return (*res, t_prepare.interval * 1e9, t_partition.interval * 1e9, nb_reqs)
+
+
+async def stream_queries(hostname, workerid, nfs, config, dname, reqs, channels, chunk_size,
+                         sink=None):
+    """
+    Send a partition in chunks of `chunk_size` queries. The next chunk is
+    written and queued on the worker while the current one is searched, and
+    each chunk's answer is reported as soon as it comes back.
+    """
+    fname = f"query.{hostname}{workerid}"
+    nb_reqs = len(reqs)
+    fifo, answer = channels.fifo_pair(workerid)
+    chunks = [reqs[i : i + chunk_size] for i in range(0, nb_reqs, chunk_size)]
+    t_prepare = Timer()
+
+    async def configs():
+        nonlocal t_prepare
+        for k, chunk in enumerate(chunks):
+            qname = join(nfs, f"{fname}.{k}")
+            with Span("prepare", worker=workerid, chunk=k) as t:
+                await asyncio.to_thread(write_queries, qname, chunk, config, dname)
+            t_prepare += t
+            yield json.dumps(config) + "\n" + "{} {} {}\n".format(qname, answer, dname)
+
+    print(f"Streaming {nb_reqs} queries in {len(chunks)} chunks on '{hostname}'")
+    answers = []
+    with Span("partition", host=hostname, worker=workerid, size=nb_reqs) as t_partition:
+        stream = channels.get(hostname, fifo, answer).pipeline(configs())
+        async with aclosing(stream):
+            async for code, out in stream:
+                k = len(answers)
+                if code:
+                    print(code, out)
+                    break
+                try:
+                    res, results = parse_answer(out, config, dname)
+                except ValueError as e:
+                    print(f"Bad answer from '{hostname}': {e}")
+                    break
+                if results is not None and sink is not None:
+                    # Indices are relative to the chunk
+                    results = results.copy()
+                    results["index"] += k * chunk_size
+                    sink(results)
+                answers.append(res)
+                os.remove(join(nfs, f"{fname}.{k}"))
+                print(f"'{hostname}' chunk {k + 1}/{len(chunks)}: {res}")
+
+    res = merge_answers(answers) if len(answers) == len(chunks) else ""
+
+    return (*res, t_prepare.interval * 1e9, t_partition.interval * 1e9, nb_reqs)
+
+
+def batch_queue(part, batch_size):
+    """
+    Queue of micro-batches of a shard's query indices, 0 means a single
+    batch. A spill file is always a single batch.
+    """
+    batches = asyncio.Queue()
+    if isinstance(part, SpillFile):
+        batches.put_nowait(part)
+        return batches
+    if batch_size <= 0:
+        batch_size = max(1, len(part))
+    for i in range(0, len(part), batch_size):
+        batches.put_nowait(part[i : i + batch_size])
+    return batches
+
+
+class Job:
+    """A micro-batch, possibly sent to several replicas, the first answer wins"""
+
+    def __init__(self, batch):
+        self.batch = batch
+        self.result = asyncio.get_running_loop().create_future()
+        self.running = 0
+
+
+class Shard:
+    """
+    Micro-batches of a shard for one diff, shared by its replicas. A batch
+    running past its deadline is offered to the other replicas once they are
+    done with their own batches.
+    """
+
+    def __init__(self, part, batch_size, rate, fleet, factor=0, minimum=1.0):
+        self.batches = batch_queue(part, batch_size)
+        self.overdue = asyncio.Queue()
+        # Batches in flight that may still be offered to other replicas
+        self.inflight = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        # [queries, seconds] answered by the shard, shared by all diffs, and
+        # by all shards
+        self.rate = rate
+        self.fleet = fleet
+        self.factor = factor
+        self.minimum = minimum
+        self.speculated = 0
+        self.won = 0
+
+    def deadline(self, size):
+        """
+        Seconds to answer a batch, `factor` times the service time observed on
+        the shard, or on all shards until the shard answered a batch. None
+        until some batch was answered.
+        """
+        queries, seconds = self.rate if self.rate[0] else self.fleet
+        if queries == 0:
+            return None
+        return max(self.minimum, self.factor * size * seconds / queries)
+
+    def answered(self, row):
+        for rate in (self.rate, self.fleet):
+            rate[0] += row[-1]
+            rate[1] += row[-2] / 1e9
+
+    async def next_overdue(self):
+        """
+        An unanswered overdue batch, None once no batch is in flight, or right
+        away if batches are never overdue
+        """
+        if self.factor <= 0:
+            return None
+        while True:
+            try:
+                job = self.overdue.get_nowait()
+            except asyncio.QueueEmpty:
+                if self.inflight == 0:
+                    return None
+                getter = asyncio.create_task(self.overdue.get())
+                idle = asyncio.create_task(self.idle.wait())
+                done, pending = await asyncio.wait(
+                    {getter, idle}, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in pending:
+                    task.cancel()
+                if getter not in done:
+                    continue
+                job = getter.result()
+            if not job.result.done():
+                return job
+
+
+async def watch(job, shard, task):
+    """Offer a job to the other replicas once it runs past its deadline"""
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    while not task.done():
+        deadline = shard.deadline(len(job.batch))
+        if deadline is None:
+            # Nothing answered yet, look again once something may have been
+            await asyncio.wait({task}, timeout=max(shard.minimum, 0.1))
+            continue
+        left = start + deadline - loop.time()
+        if left > 0:
+            await asyncio.wait({task}, timeout=left)
+            continue
+        print(f"Batch of {len(job.batch)} queries overdue after {deadline:.1f}s")
+        shard.overdue.put_nowait(job)
+        return
 
 
-def read_p2p(sce_name):
-    """Read a point-to-point scenario file"""
-    reqs = []
+async def attempt(job, shard, send, speculate=False):
+    """
+    Send a job's batch, and with `speculate` offer it to the other replicas
+    once it is overdue. An attempt is never cancelled when another one wins:
+    its worker still owes the answer, which is read and dropped. Returns the
+    row if this attempt won, None otherwise.
+    """
+    job.running += 1
+    # Named after the replica's task, whose track in the trace it stays on
+    task = asyncio.create_task(send(), name=asyncio.current_task().get_name())
+    try:
+        if speculate and shard.factor > 0:
+            await watch(job, shard, task)
+        row = await task
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        job.running -= 1
+
+    if job.result.done():
+        return None
+    # A failed batch may still be answered by another attempt
+    if len(row) <= 3 and job.running > 0:
+        return None
+    job.result.set_result(row)
+    if len(row) > 3:
+        shard.answered(row)
+    return row
+
+
+async def serve_shard(hostname, workerid, nfs, config, dname, reqs, shard, channels,
+                      chunk_size=0, sink=None):
+    """
+    Send micro-batches from a shard's queue to one of its replicas until the
+    queue is empty, so each batch goes to whichever replica frees up first.
+    Then take over overdue batches of the other replicas, if any.
+    `sink(idx, results)` gets the per-query results of the queries reqs[idx].
+    """
+    rows = []
+    while True:
+        try:
+            job = Job(shard.batches.get_nowait())
+            primary = True
+        except asyncio.QueueEmpty:
+            job = await shard.next_overdue()
+            if job is None:
+                return rows
+            primary = False
+            shard.speculated += 1
+            print(f"Sending an overdue batch of {len(job.batch)} queries to '{hostname}'")
+
+        to_sink = None
+        if sink is not None:
+            def to_sink(results, job=job):
+                # Results of a losing attempt are dropped
+                if not job.result.done():
+                    sink(job.batch[results["index"]], results)
+
+        def send(job=job, to_sink=to_sink):
+            if isinstance(job.batch, SpillFile):
+                return send_queries(hostname, workerid, nfs, config, dname, None, channels,
+                                    qfile=job.batch)
+            return send_queries(
+                hostname, workerid, nfs, config, dname, reqs[job.batch], channels,
+                chunk_size, to_sink,
+            )
+
+        if primary:
+            shard.inflight += 1
+            shard.idle.clear()
+            try:
+                row = await attempt(job, shard, send, speculate=True)
+            finally:
+                shard.inflight -= 1
+                if shard.inflight == 0:
+                    shard.idle.set()
+        else:
+            row = await attempt(job, shard, send)
+            if row is not None and len(row) > 3:
+                shard.won += 1
+        if row is not None:
+            rows.append(row)
+
+
+async def serve_diffs(hostname, workerid, nfs, config, diffs, reqs, shards, channels,
+                      chunk_size=0, sinks=None):
+    """
+    Serve a shard's queue for every diff in turn, moving on to the next diff
+    as soon as the current queue is empty instead of waiting for the other
+    workers. Returns the rows of this replica for each diff.
+    """
+    sinks = sinks or [None] * len(diffs)
+    return [
+        await serve_shard(hostname, workerid, nfs, config, dname, reqs, shard, channels,
+                          chunk_size, sink)
+        for dname, shard, sink in zip(diffs, shards, sinks)
+    ]
+
+
+def answered(stats):
+    """Number of queries answered over all diffs, from their merged rows"""
+    return int(sum(row[-1] for expe in stats for row in expe if len(row) > 3))
 
-    with open(sce_name) as f:
-        for line in f:
-            if not line.strip() or line[0] != 'q':
-                continue
-            reqs.append([int(x) for x in line.split()[1:]])
 
-    return reqs
+def merge_rows(rows):
+    """Sum the result rows of a shard's batches, skipping failed ones"""
+    done = [row for row in rows if len(row) > 3]
+    if len(done) < len(rows):
+        print(f"{len(rows) - len(done)} of {len(rows)} batches failed")
+    if not done:
+        return rows[0]
+    return tuple(merge_answers(done))
+
+
+def latency_metrics(rows, wids):
+    """
+    Batch latency histograms (of t_partition, in ns) and throughput of one
+    diff, for each shard and overall. `rows` maps a shard to its batches' rows,
+    throughput is per second of a replica being busy with the shard.
+    """
+    total = Histogram()
+    workers = []
+    for k in sorted(rows):
+        done = [row for row in rows[k] if len(row) > 3]
+        hist = Histogram([row[-2] for row in done])
+        busy = sum(row[-2] for row in done) / 1e9
+        size = sum(row[-1] for row in done)
+        workers.append({"worker": wids[k], "qps": size / busy if busy else 0,
+                        **hist.summary()})
+        total += hist
+    # The slowest shard sets the pace of the diff
+    slowest = min((w["qps"] for w in workers if w["qps"]), default=0)
+    makespan = max(
+        (sum(row[-2] for row in rows[k] if len(row) > 3) / 1e9 for k in rows), default=0
+    )
+    size = sum(row[-1] for k in rows for row in rows[k] if len(row) > 3)
+    return {
+        "qps": size / makespan if makespan else 0,
+        "slowest_worker_qps": slowest,
+        "batch": total.to_dict(),
+        "workers": workers,
+    }
+
+
+def make_channels(args):
+    return Channels(
+        binary=args.wire == "binary",
+        timeout=args.timeout or None,
+        connect_limit=args.connect_limit,
+        host_limit=args.host_limit,
+        shell=["bash", "-s"] if args.local_shell else None,
+        shm=args.shm,
+        fifo_dir=args.fifo_dir,
+    )
+
+
+def host_config(config, codecs, host):
+    """Runtime configuration of the workers of a host, with its own codec if any"""
+    if host not in codecs:
+        return config
+    config = dict(config)
+    config.pop("codec", None)
+    codec = resolve(codecs[host])
+    if codec is not None:
+        config["codec"] = codec
+    return config
+
+
+async def dispatch(wids, replicas, reqs, parts, nfs, config, diffs, args, sinks=None,
+                   codecs=None):
+    """
+    Serve every replica of every shard concurrently from the event loop and
+    return one row per (diff, shard), and the latency metrics of each diff.
+    parts[i][k] are the indices in reqs of the queries of shard k for diff i,
+    or its spill file. `codecs` maps hosts to their codec, overriding the
+    one of `config`.
+    """
+    codecs = codecs or {}
+    async with make_channels(args) as channels:
+        # One queue per shard and diff, one load per replica covering all diffs
+        shards = []
+        fleet = [0, 0.0]
+        for k in range(len(wids)):
+            rate = [0, 0.0]
+            shards.append([
+                Shard(part[k], args.batch_size, rate, fleet, args.speculate, args.speculate_min)
+                for part in parts
+            ])
+        # Named tasks, so each replica has its own track in the trace
+        workload = [
+            (k, asyncio.create_task(
+                serve_diffs(host, wid, nfs, host_config(config, codecs, host), diffs, reqs,
+                            shards[k], channels, args.chunk_size, sinks),
+                name=f"{host}/worker{wid}",
+            ))
+            for k, (wid, hosts) in enumerate(zip(wids, replicas))
+            for host in hosts if any(len(part[k]) > 0 for part in parts)
+        ]
+        results = await asyncio.gather(*(load for _, load in workload))
+
+    rows = defaultdict(lambda: [[] for _ in diffs])
+    for (k, _), res in zip(workload, results):
+        for i, diff_rows in enumerate(res):
+            rows[k][i].extend(diff_rows)
+    # One experiment per diff
+    # Shards with nothing to do for a diff (e.g., all cached) have no row
+    stats = [
+        [merge_rows(rows[k][i]) for k in sorted(rows) if rows[k][i]]
+        for i in range(len(diffs))
+    ]
+    latency = [
+        latency_metrics({k: rows[k][i] for k in rows if rows[k][i]}, wids)
+        for i in range(len(diffs))
+    ]
+    for i, diff in enumerate(latency):
+        diff["speculated"] = sum(shards[k][i].speculated for k in range(len(wids)))
+        diff["speculation_won"] = sum(shards[k][i].won for k in range(len(wids)))
+    return stats, latency
+
 
 def get_node_num(xyfile):
     with open(xyfile, "r") as f:
@@ -129,71 +574,225 @@ def get_node_num(xyfile):
         _, num, _, _ = line.split(' ')
     return int(num)
 
+def worker_config(args):
+    """Runtime configuration of the resident processes"""
+    config = {
+        "hscale": args.h_scale,
+        "fscale": args.f_scale,
+        "time": get_time_ns(args),
+        "itrs": -1,
+        "k_moves": args.k_moves,
+        "threads": args.omp,
+        "verbose": args.verbose > 0,
+        "debug": args.debug,
+        "thread_alloc": args.thread_alloc,
+        "no_cache": args.no_cache,
+    }
+    if args.wire != "text":
+        config["wire"] = args.wire
+    codec = resolve(args.codec)
+    if codec is not None:
+        config["codec"] = codec
+    return config
+
+def check_options(worker_conf, conf, args):
+    """Options needing the binary wire format"""
+    if "codec" in worker_conf or conf.get("codecs"):
+        assert args.wire == "binary", "Compression needs --wire binary"
+    if args.shm:
+        assert args.wire == "binary", "--shm needs --wire binary"
+
+def select_workers(replicas, worker):
+    """Shards to serve and their replicas, all of them if worker is -1"""
+    if worker == -1:
+        return range(len(replicas)), replicas
+    return [worker], [replicas[worker]]
+
+def wait_ready(wids, replicas, args):
+    """Never send to a worker still loading its shard, or gone"""
+    if args.wait_ready <= 0:
+        return
+    workers = asyncio.run(wait_fleet(wids, replicas, args.wait_ready))
+    not_ready = [str(w) for w in workers if w.state != "ready"]
+    if not_ready:
+        print("Workers not ready:", " ".join(not_ready))
+        exit(1)
+
+def run_metrics(num_queries, num_unique, num_partitions, t_read, t_workload, t_process,
+                stats, latency):
+    """Metrics of a run, as written to the output directory"""
+    return {
+        "num_queries": num_queries,
+        "num_unique": num_unique,
+        "num_partitions": num_partitions,
+        "t_read": t_read,
+        "t_workload": t_workload,
+        "t_process": t_process,
+        "qps": answered(stats) / t_process,
+        "latency": {"diffs": latency},
+    }
+
+def run_spilled(conf, args):
+    """
+    Run without loading the scenario: it is read and partitioned in one pass
+    into spill files on the NFS, which are sent to the workers as they are.
+    """
+    sce_name   = conf['scenfile']
+    diffs      = conf['diffs']
+    replicas   = partition_replicas(conf)
+    nfs        = conf['nfs']
+    nodenum    = get_node_num(conf['xy_file'])
+    maxworker  = len(replicas)
+    worker     = args.worker
+
+    assert not (args.dedup or args.result_cache or args.per_query), \
+        "--spill does not keep the queries, no --dedup, --result-cache nor --per-query"
+    assert args.batch_order == "none" and args.batch_size <= 0 and args.chunk_size <= 0, \
+        "--spill sends each shard as a whole, no --batch-order, --batch-size nor --chunk-size"
+
+    worker_conf = worker_config(args)
+    check_options(worker_conf, conf, args)
+    # Spill files are shared by all hosts and never compressed: every host
+    # gets the configuration hashed into their header, without codec
+    if worker_conf.pop("codec", None) or conf.get("codecs"):
+        print("Spill files are not compressed, ignoring --codec and the cluster's codecs")
+    wids, replicas = select_workers(replicas, worker)
+
+    code, table = node_table(nodenum, maxworker, conf['partmethod'], conf['partkey'],
+                             args.check_dist)
+    if code:
+        print(code, table)
+        exit(1)
+
+    # Text query files do not depend on the diff, binary ones carry its id
+    binary = worker_conf.get("wire") == "binary"
+    files = [
+        [SpillFile(join(nfs, f"spill.{wid}.{i}"), worker_conf, dname)
+         for i, dname in enumerate(diffs if binary else diffs[:1])]
+        for wid in wids
+    ]
+    try:
+        # Reading and partitioning are a single pass
+        with Span("workload") as w:
+            total_qs = spill_p2p(sce_name, table, maxworker, wids, files)
+        print(f"Spilled {total_qs} queries for {replicas}.")
+        for shard in files:
+            print("#queries:", len(shard[0]))
+
+        wait_ready(wids, replicas, args)
+
+        parts = [[shard[i if binary else 0] for shard in files] for i in range(len(diffs))]
+        with Span("process") as p:
+            stats, latency = asyncio.run(dispatch(wids, replicas, None, parts, nfs, worker_conf,
+                                                  diffs, args))
+    finally:
+        for shard in files:
+            for f in shard:
+                f.remove()
+
+    data = run_metrics(total_qs, total_qs, maxworker, 0.0, w.interval, p.interval,
+                       stats, latency)
+    return data, stats, None
+
 def run(conf, args):
+    if args.spill:
+        return run_spilled(conf, args)
+
     sce_name   = conf['scenfile']
     diffs      = conf['diffs']
-    hosts      = conf['workers']
+    replicas   = partition_replicas(conf)
     partmethod = conf['partmethod']
     partkey    = conf['partkey']
     nfs        = conf['nfs']
     nodenum    = get_node_num(conf['xy_file'])
-    maxworker  = len(hosts)
+    maxworker  = len(replicas)
     # sending query to a specific worker, -1 means to all workers
     worker     = args.worker
 
-    with Timer() as r:
+    with Span("read") as r:
         reqs   = read_p2p(sce_name)
 
     total_qs = len(reqs)
-
-    worker_conf = {
-        "hscale": args.h_scale,
-        "fscale": args.f_scale,
-        "time": get_time_ns(args),
-        "itrs": -1,
-        "k_moves": args.k_moves,
-        "threads": args.omp,
-        "verbose": args.verbose > 0,
-        "debug": args.debug,
-        "thread_alloc": args.thread_alloc,
-        "no_cache": args.no_cache,
-    }
-
-    wids = range(maxworker)
-    if worker != -1:
-        hosts = [hosts[worker]]
-        wids = [worker]
-    print(f"Preparing to send {total_qs} queries to {hosts}.")
-    with Timer() as w:
-        code, parts = make_parts(reqs, nodenum, maxworker, partmethod, partkey, worker)
+    # Each distinct (s, t) pair is only searched once per diff
+    inverse = None
+    if args.dedup:
+        reqs, inverse = dedup(reqs)
+        print(f"{len(reqs)} distinct queries out of {total_qs}")
+
+    worker_conf = worker_config(args)
+    check_options(worker_conf, conf, args)
+
+    cache = None
+    if args.result_cache is not None:
+        cache = ResultCache(args.result_cache, args.cache_size << 20)
+    per_query = args.per_query or cache is not None
+    if per_query:
+        assert args.wire == "binary", "Per-query results need --wire binary"
+        worker_conf["per_query"] = True
+
+    wids, replicas = select_workers(replicas, worker)
+    print(f"Preparing to send {total_qs} queries to {replicas}.")
+    with Span("workload") as w:
+        code, parts = make_parts(reqs, nodenum, maxworker, partmethod, partkey,
+                                 worker, args.check_dist)
         if code:
             print(code, parts)
             exit(1)
+        # Queries sharing a CPD block or a region are searched one after the other
+        if args.batch_order != "none":
+            table = coords = None
+            if args.batch_order == "block":
+                _, table = node_table(nodenum, maxworker, partmethod, partkey)
+            elif args.batch_order == "hilbert":
+                coords = read_coords(conf['xy_file'], nodenum)
+            parts = order_parts(parts, order_keys(args.batch_order, reqs, table, coords))
     for part in parts:
         print("#queries:", len(part))
 
-    with Timer() as p:
-        stats = []
-        # Run one experiment per diff
-        for i, dname in enumerate(diffs):
-            workload = zip(hosts, wids, cycle([nfs]), cycle([worker_conf]), cycle([dname]), parts)
-            with Pool(maxworker) as pool:
-                results = [
-                    pool.apply_async(send_queries, load)
-                    for load in workload if len(load[-1]) > 0
-                ]
-                stats.append([res.get() for res in results])
-
-    data = {
-        "num_queries": total_qs,
-        "num_partitions": maxworker,
-        "t_read": r.interval,
-        "t_workload": w.interval,
-        "t_process": p.interval,
-    }
-    return data, stats
-
-def output(data, stats, args):
+    store = sinks = None
+    if per_query:
+        # Results go straight to the output directory, in scenario order
+        dirname = None if args.output is None else join(args.output, "results")
+        store = ResultStore(dirname, len(diffs), total_qs, inverse)
+        sinks = [store.sink(i) for i in range(len(diffs))]
+
+    # Per diff, send only the queries missing from the result cache
+    sends = [parts] * len(diffs)
+    if cache is not None:
+        chash = search_hash(worker_conf, conf['xy_file'])
+        dhashes = [file_hash(dname) for dname in diffs]
+        sends, hits = [], []
+        for i, dhash in enumerate(dhashes):
+            hit, cached = cache.lookup(dhash, chash, reqs)
+            print(f"{hit.sum()} of {len(reqs)} queries cached for {dhash}")
+            store.write(i, np.flatnonzero(hit), cached[hit])
+            hits.append(hit)
+            sends.append([part[~hit[part]] for part in parts])
+
+    wait_ready(wids, replicas, args)
+
+    with Span("process") as p:
+        stats, latency = asyncio.run(dispatch(wids, replicas, reqs, sends, nfs, worker_conf, diffs,
+                                     args, sinks, conf.get('codecs')))
+
+    data = run_metrics(total_qs, len(reqs), maxworker, r.interval, w.interval, p.interval,
+                       stats, latency)
+
+    if cache is not None:
+        data["cache_hits"] = [int(hit.sum()) for hit in hits]
+        for i, (dhash, hit) in enumerate(zip(dhashes, hits)):
+            new = np.flatnonzero(~hit)
+            values, done = store.read(i, new)
+            cache.insert(dhash, chash, reqs[new[done]], values[done])
+    if store is not None:
+        store.flush()
+        # Search time of every query, ns
+        for i, diff in enumerate(latency):
+            done = np.asarray(store.columns["done"][i])
+            diff["query"] = Histogram(store.columns["t_search"][i][done]).to_dict()
+    return data, stats, store
+
+def output(data, stats, args, store=None):
     # Header for partitions' results (in CSV)
     header = [
         "expe",
@@ -218,6 +817,9 @@ def output(data, stats, args):
         for i, expe in enumerate(stats):
             for row in expe:
                 print(i, row)
+        if store is not None:
+            for i, cost in enumerate(store.columns["cost"]):
+                print(i, "cost:", cost)
     else:
         # Assume args.output is a directory
         dirname = args.output
@@ -236,7 +838,9 @@ def output(data, stats, args):
         with open(join(dirname, "parts.csv"), "w") as f:
             writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
             writer.writerow(header)
-            writer.writerows([[i] + row for i, row in stats])
+            writer.writerows(
+                [[i, *row] for i, expe in enumerate(stats) for row in expe]
+            )
 
 def test(args):
     conf =  {
@@ -252,17 +856,23 @@ def test(args):
     maxworker = 100
     conf["workers"] = ["localhost" for i in range(maxworker)]
 
-    data, stats = run(conf, args)
-    output(data, stats, args)
+    data, stats, store = run(conf, args)
+    output(data, stats, args, store)
+    if args.trace is not None:
+        tracing.save(args.trace)
 
 def main():
+    if args.trace is not None:
+        tracing.enable()
     if args.test:
         test(args)
         return
     conf_path = args.c
     cluster_conf = json.load(open(conf_path, "r"))
-    data, stats = run(cluster_conf, args)
-    output(data, stats, args)
+    data, stats, store = run(cluster_conf, args)
+    output(data, stats, args, store)
+    if args.trace is not None:
+        tracing.save(args.trace)
 
 
 if __name__ == "__main__":
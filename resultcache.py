@@ -0,0 +1,103 @@
+#
+# Persistent cache of per-query results on the head node.
+#
+# Results are keyed by (source, target, diff content hash, search config
+# hash). Each (diff, config) pair has its own segment: a .npy file of records
+# sorted by the (source, target) key, mmap'd on lookup. Once the cache grows
+# over its size limit, the least recently used segments are evicted.
+#
+import hashlib
+import os
+from glob import glob
+from os.path import join, isfile, getsize
+
+import numpy as np
+
+import wire
+from scenario import pair_keys
+
+
+# Stored value of a query, i.e., its result without the index in the batch
+VALUE = np.dtype([(name, wire.RESULT[name]) for name in wire.RESULT.names[1:]])
+RECORD = np.dtype([("key", "<u8")] + [(name, VALUE[name]) for name in VALUE.names])
+
+# Runtime options that change the result of a search
+SEARCH_KEYS = ["hscale", "fscale", "time", "itrs", "k_moves"]
+
+
+def file_hash(fname):
+    """Content hash of a diff file, falls back to its name if unreadable"""
+    h = hashlib.sha1()
+    if isfile(fname):
+        with open(fname, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    else:
+        h.update(fname.encode())
+    return h.hexdigest()[:16]
+
+
+def search_hash(config, xy_file):
+    """Hash of everything in a runtime configuration that changes results"""
+    search = {k: config.get(k) for k in SEARCH_KEYS}
+    search["xy_file"] = xy_file
+    return f"{wire.config_hash(search):08x}"
+
+
+class ResultCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def segment(self, dhash, chash):
+        return join(self.cache_dir, f"results-{dhash}-{chash}.npy")
+
+    def lookup(self, dhash, chash, reqs):
+        """Boolean mask of the cached queries in reqs, and their values"""
+        values = np.zeros(len(reqs), dtype=VALUE)
+        fname = self.segment(dhash, chash)
+        if not isfile(fname):
+            return np.zeros(len(reqs), dtype=bool), values
+
+        os.utime(fname)  # Mark as recently used
+        seg = np.load(fname, mmap_mode="r")
+        keys = pair_keys(reqs)
+        pos = np.minimum(np.searchsorted(seg["key"], keys), len(seg) - 1)
+        hit = seg["key"][pos] == keys
+        for name in VALUE.names:
+            values[name][hit] = seg[name][pos[hit]]
+
+        return hit, values
+
+    def insert(self, dhash, chash, reqs, values):
+        """Add (or overwrite) the values of some queries"""
+        if len(reqs) == 0:
+            return
+        new = np.zeros(len(reqs), dtype=RECORD)
+        new["key"] = pair_keys(reqs)
+        for name in VALUE.names:
+            new[name] = values[name]
+
+        fname = self.segment(dhash, chash)
+        if isfile(fname):
+            new = np.concatenate([new, np.load(fname)])
+        # np.unique keeps the first occurrence, i.e., the newest value
+        _, first = np.unique(new["key"], return_index=True)
+        tmp = f"{fname}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, new[first])
+        os.replace(tmp, fname)
+
+        self.evict()
+
+    def evict(self):
+        """Drop the least recently used segments until under the size limit"""
+        segments = sorted(
+            glob(join(self.cache_dir, "results-*.npy")), key=os.path.getmtime
+        )
+        total = sum(getsize(f) for f in segments)
+        while segments and total > self.max_bytes:
+            oldest = segments.pop(0)
+            total -= getsize(oldest)
+            os.remove(oldest)
@@ -0,0 +1,87 @@
+#
+# Columnar store of per-query results on the head node.
+# One (ndiffs, N) array per column, in the order of the scenario, memory-mapped
+# from `{column}.npy` in the output directory so results are written as the
+# answers stream in and can be read back with `np.load(..., mmap_mode="r")`.
+# When queries were deduplicated, the result of a distinct query is written
+# at every position of the scenario where it occurs.
+#
+import os
+from os.path import join
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from resultcache import VALUE
+
+
+# Whether a query has a result, i.e., it was answered or found in the cache
+DONE = "done"
+COLUMNS = [(name, VALUE[name]) for name in VALUE.names] + [(DONE, np.dtype(bool))]
+
+
+class ResultStore:
+    def __init__(self, dirname, ndiffs, nqueries, inverse=None):
+        """
+        `inverse` maps every query of the scenario to its distinct query, as
+        returned by `scenario.dedup`, None if queries were not deduplicated.
+        Without `dirname`, the columns are kept in memory.
+        """
+        self.dirname = dirname
+        if dirname is not None:
+            os.makedirs(dirname, exist_ok=True)
+        self.columns = {
+            name: self.column(name, dtype, (ndiffs, nqueries)) for name, dtype in COLUMNS
+        }
+
+        # Positions of each distinct query in the scenario, grouped together
+        self.order = self.starts = None
+        if inverse is not None:
+            self.order = np.argsort(inverse, kind="stable")
+            counts = np.bincount(inverse)
+            self.starts = np.concatenate([[0], np.cumsum(counts)])
+
+    def column(self, name, dtype, shape):
+        if self.dirname is None:
+            return np.zeros(shape, dtype=dtype)
+        return open_memmap(join(self.dirname, f"{name}.npy"), "w+", dtype, shape)
+
+    def positions(self, idx):
+        """
+        Positions in the scenario of the distinct queries idx, and for each
+        position the index in idx it comes from
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        if self.order is None:
+            return idx, np.arange(len(idx))
+        counts = self.starts[idx + 1] - self.starts[idx]
+        src = np.repeat(np.arange(len(idx)), counts)
+        offsets = np.arange(len(src)) - np.repeat(np.cumsum(counts) - counts, counts)
+        return self.order[self.starts[idx][src] + offsets], src
+
+    def write(self, i, idx, values):
+        """Store the VALUE records of the distinct queries idx for diff i"""
+        pos, src = self.positions(idx)
+        for name in VALUE.names:
+            self.columns[name][i, pos] = values[name][src]
+        self.columns[DONE][i, pos] = True
+
+    def read(self, i, idx):
+        """VALUE records and done flags of the distinct queries idx for diff i"""
+        idx = np.asarray(idx, dtype=np.int64)
+        first = idx if self.order is None else self.order[self.starts[idx]]
+        values = np.zeros(len(idx), dtype=VALUE)
+        for name in VALUE.names:
+            values[name] = self.columns[name][i, first]
+        return values, np.asarray(self.columns[DONE][i, first])
+
+    def sink(self, i):
+        """Sink of `send_queries` for diff i"""
+        def sink(idx, results):
+            self.write(i, idx, results)
+        return sink
+
+    def flush(self):
+        for col in self.columns.values():
+            if isinstance(col, np.memmap):
+                col.flush()
@@ -0,0 +1,94 @@
+#
+# Scenario loading shared by the drivers.
+# Queries are kept as a (N, 2) uint32 array of (source, target) pairs, and a
+# binary sidecar cache is written next to the scenario so later runs only need
+# to mmap it.
+#
+import os
+from glob import glob, escape
+
+import numpy as np
+
+
+# Read the text scenario this many bytes at a time
+CHUNK_BYTES = 1 << 26
+
+
+def cache_name(sce_name):
+    """Name of the sidecar cache, keyed on the scenario's size and mtime"""
+    st = os.stat(sce_name)
+    return f"{sce_name}.{st.st_size}-{st.st_mtime_ns}.npy"
+
+
+def parse_chunk(lines):
+    """Parse the 'q s t' lines of a chunk into a (n, 2) array"""
+    text = " ".join(l[1:] for l in lines if l[0] == "q")
+    return np.fromstring(text, dtype=np.uint32, sep=" ").reshape(-1, 2)
+
+
+def iter_p2p(sce_name, chunk_bytes=CHUNK_BYTES):
+    """Yield the queries of a text scenario file as (n, 2) arrays"""
+    with open(sce_name) as f:
+        while True:
+            lines = f.readlines(chunk_bytes)
+            if not lines:
+                break
+            yield parse_chunk(lines)
+
+
+def parse_p2p(sce_name):
+    """Parse a text point-to-point scenario file"""
+    chunks = list(iter_p2p(sce_name))
+    if not chunks:
+        return np.empty((0, 2), dtype=np.uint32)
+    return np.concatenate(chunks)
+
+
+def write_cache(cname, reqs):
+    """Atomically write the sidecar cache, dropping stale ones"""
+    base = cname.rsplit(".", 2)[0]
+    tmp = f"{cname}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, reqs)
+    os.replace(tmp, cname)
+
+    for stale in glob(f"{escape(base)}.*-*.npy"):
+        if stale != cname:
+            os.remove(stale)
+
+
+def read_p2p(sce_name, use_cache=True):
+    """
+    Read a point-to-point scenario file as a (N, 2) uint32 array of
+    (source, target), going through the sidecar cache when possible.
+    """
+    if not use_cache:
+        return parse_p2p(sce_name)
+
+    cname = cache_name(sce_name)
+    if os.path.isfile(cname):
+        return np.load(cname, mmap_mode="r")
+
+    reqs = parse_p2p(sce_name)
+    try:
+        write_cache(cname, reqs)
+    except OSError as e:
+        print(f"Cannot cache '{sce_name}': {e}")
+        return reqs
+
+    return np.load(cname, mmap_mode="r")
+
+
+def pair_keys(reqs):
+    """One uint64 key per (source, target) pair"""
+    return (reqs[:, 0].astype(np.uint64) << np.uint64(32)) | reqs[:, 1].astype(np.uint64)
+
+
+def dedup(reqs):
+    """
+    Distinct queries of reqs, and for each query its index among them, so
+    that per-query values `v` of the distinct queries expand back with
+    `v[inverse]`.
+    """
+    _, first, inverse = np.unique(pair_keys(reqs), return_index=True, return_inverse=True)
+    return reqs[first], inverse
@@ -0,0 +1,173 @@
+#
+# This script is called at the head node.
+# Long-running query service: clients send point-to-point queries over a TCP
+# or Unix socket, one per line, and get one line back per query as soon as
+# its result comes in.
+#
+#   request: "<id> <source> <target>\n"
+#   reply:   "<id> <cost> <n_expanded> <t_search>\n" (t_search in ns)
+#            "<id> error <message>\n"
+#
+# Each query goes to the shard owning its target, where queries are grouped
+# in micro-batches: a batch leaves as soon as it holds --window-size queries,
+# or --window-ms after its first query, whichever comes first. Every replica
+# of a shard takes the next batch as soon as it is free.
+#
+from args import args
+from partition import node_table, WID
+from cluster import partition_replicas
+from process_query import get_node_num, worker_config, make_channels, send_queries
+
+import asyncio
+import json
+import os
+
+import numpy as np
+
+
+class Shard:
+    """Pending queries of a shard, served by all of its replicas"""
+
+    def __init__(self, workerid, hosts):
+        self.workerid = workerid
+        self.hosts = hosts
+        self.pending = asyncio.Queue()
+
+    async def next_batch(self, window_size, window):
+        """Wait for a query, then gather more until the window closes"""
+        loop = asyncio.get_running_loop()
+        batch = [await self.pending.get()]
+        deadline = loop.time() + window
+        while len(batch) < window_size:
+            try:
+                batch.append(self.pending.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.pending.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def serve(self, hostname, nfs, config, dname, channels, window_size, window):
+        """Send micro-batches to one replica, forever"""
+        while True:
+            batch = await self.next_batch(window_size, window)
+            futures = [future for _, future in batch]
+
+            def sink(results):
+                for rec in results:
+                    future = futures[rec["index"]]
+                    if not future.done():
+                        future.set_result(rec)
+
+            error = f"no result from '{hostname}'"
+            try:
+                reqs = np.array([query for query, _ in batch], dtype=np.uint32).reshape(-1, 2)
+                await send_queries(
+                    hostname, self.workerid, nfs, config, dname, reqs, channels, sink=sink
+                )
+            except Exception as e:
+                # Only this batch fails, the replica keeps serving
+                print(f"Batch of {len(batch)} queries failed on '{hostname}': {e}")
+                error = f"batch failed on '{hostname}': {e}"
+            finally:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(RuntimeError(error))
+
+
+class Server:
+    def __init__(self, conf, args):
+        self.nfs = conf["nfs"]
+        self.dname = conf["diffs"][0]
+        self.nodenum = get_node_num(conf["xy_file"])
+        replicas = partition_replicas(conf)
+        code, self.table = node_table(
+            self.nodenum, len(replicas), conf["partmethod"], conf["partkey"]
+        )
+        if code:
+            raise RuntimeError(f"Cannot distribute nodes: {self.table}")
+
+        self.shards = [Shard(wid, hosts) for wid, hosts in enumerate(replicas)]
+        self.config = worker_config(args)
+        self.config["per_query"] = True
+        self.window_size = args.window_size
+        self.window = args.window_ms / 1000
+
+    async def query(self, qid, source, target, writer):
+        if min(source, target) < 0 or max(source, target) >= self.nodenum:
+            writer.write(f"{qid} error unknown node\n".encode())
+            return
+        future = asyncio.get_running_loop().create_future()
+        shard = self.shards[self.table[target, WID]]
+        shard.pending.put_nowait(((source, target), future))
+        try:
+            rec = await future
+            reply = f"{qid} {rec['cost']} {rec['n_expanded']} {rec['t_search']}\n"
+        except RuntimeError as e:
+            reply = f"{qid} error {e}\n"
+        writer.write(reply.encode())
+
+    async def handle(self, reader, writer):
+        """Serve a client until it closes its side of the connection"""
+        tasks = set()
+        try:
+            async for line in reader:
+                try:
+                    qid, source, target = line.split()
+                    source, target = int(source), int(target)
+                except ValueError:
+                    writer.write(b"error expected '<id> <source> <target>'\n")
+                    continue
+                task = asyncio.create_task(
+                    self.query(qid.decode(), source, target, writer)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def run(self, args):
+        async with make_channels(args) as channels:
+            loads = [
+                shard.serve(host, self.nfs, self.config, self.dname, channels,
+                            self.window_size, self.window)
+                for shard in self.shards
+                for host in shard.hosts
+            ]
+            if args.unix is not None:
+                server = await asyncio.start_unix_server(self.handle, args.unix)
+            else:
+                server = await asyncio.start_server(self.handle, args.host, args.port)
+            print("Serving on", ", ".join(str(s.getsockname()) for s in server.sockets))
+            try:
+                async with server:
+                    await asyncio.gather(server.serve_forever(), *loads)
+            finally:
+                if args.unix is not None and os.path.exists(args.unix):
+                    os.remove(args.unix)
+
+
+def main():
+    # Per-query results only exist in the binary format
+    args.wire = "binary"
+    conf = json.load(open(args.c, "r"))
+    try:
+        asyncio.run(Server(conf, args).run(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#
+# Shared-memory buffers for the workers on the head node's own host.
+# A batch is written, in the binary wire format, to a POSIX shared memory
+# segment instead of a file on the NFS, and the worker writes its answer to a
+# second segment sized by the driver. Segments live in /dev/shm, so the worker
+# opens them by path like any query file. The FIFOs then only carry the
+# runtime configuration and the size of the answer (see channel.LocalChannel).
+#
+from multiprocessing import shared_memory
+from os.path import join
+
+import numpy as np
+
+import wire
+
+
+SHM_DIR = "/dev/shm"
+
+
+class Segment:
+    """A shared memory segment the driver owns, removed on close"""
+
+    def __init__(self, size):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+        self.path = join(SHM_DIR, self.shm.name.lstrip("/"))
+
+    @property
+    def buf(self):
+        return self.shm.buf
+
+    def read(self, size):
+        """Copy of the first `size` bytes, leaving no view of the segment"""
+        with self.shm.buf[:size] as view:
+            return bytes(view)
+
+    def close(self):
+        """Unmap and remove the segment, no view of it may be left"""
+        try:
+            self.shm.close()
+        finally:
+            self.shm.unlink()
+
+
+def query_segment(reqs, did, chash, flags=0):
+    """Segment holding a binary query file, never compressed"""
+    seg = Segment(wire.HEADER.size + len(reqs) * 2 * wire.QUERY.itemsize)
+    wire.HEADER.pack_into(seg.buf, 0, wire.MAGIC_QUERY, wire.VERSION, flags, len(reqs),
+                          did, chash)
+    queries = np.ndarray((len(reqs), 2), dtype=wire.QUERY, buffer=seg.buf,
+                         offset=wire.HEADER.size)
+    queries[:] = reqs
+    del queries
+    return seg
+
+
+def answer_size(count, flags=0):
+    """Bytes of the answer to `count` queries"""
+    size = wire.HEADER.size + wire.ANSWER.itemsize
+    if flags & wire.PER_QUERY:
+        size += count * wire.RESULT.itemsize
+    return size
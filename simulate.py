@@ -0,0 +1,140 @@
+# This script is called at the head node
+# Discrete-event simulation of a run, to size the cluster before booking it.
+# Queries are routed as process_query.py does (make_parts), split into
+# micro-batches and served by the replicas of each shard, each batch going to
+# whichever replica is free first. A batch costs a transport overhead plus the
+# service time of its queries, spread over the worker's threads.
+
+
+import argparse
+import heapq
+import itertools
+import json
+from sys import argv
+
+import numpy as np
+
+from scenario import read_p2p
+from plan_alloc import read_costs
+from process_query import make_parts, get_node_num
+
+
+def fit_service(parts_csv, expe=0):
+    """Mean search time per query (s) of a previous parts.csv, t_search in ns"""
+    costs = read_costs(parts_csv, "t_search", expe)
+    return float(np.mean(costs)) * 1e-9
+
+
+def service_times(n, service, jitter, rng):
+    """Service time of n queries, lognormal around `service` if jitter > 0"""
+    if jitter <= 0:
+        return np.full(n, service)
+    sigma = np.sqrt(np.log1p(jitter ** 2))
+    return rng.lognormal(np.log(service) - sigma ** 2 / 2, sigma, n)
+
+
+def simulate_shard(times, nreplicas, batch_size, overhead, threads, ndiffs):
+    """
+    Finish time of each replica of a shard, given the service time of each of
+    its queries. Diffs are served one after the other by every replica.
+    """
+    if batch_size <= 0:
+        batch_size = max(1, len(times))
+    starts = np.arange(0, len(times), batch_size)
+    batches = np.add.reduceat(times, starts) / threads + overhead if len(times) else []
+
+    # Replicas as a heap of (time it is free, replica)
+    free = [(0.0, r) for r in range(nreplicas)]
+    for _ in range(ndiffs):
+        for cost in batches:
+            t, r = heapq.heappop(free)
+            heapq.heappush(free, (t + cost, r))
+    finish = np.zeros(nreplicas)
+    for t, r in free:
+        finish[r] = t
+    return finish
+
+
+def simulate(reqs, nodenum, nworkers, partmethod, partkey, args, rng):
+    code, parts = make_parts(reqs, nodenum, nworkers, partmethod, partkey, -1)
+    if code:
+        raise RuntimeError(f"Cannot distribute nodes: {parts}")
+    finish = np.array([
+        simulate_shard(
+            service_times(len(part), args.service, args.jitter, rng), args.replicas,
+            args.batch_size, args.overhead, args.threads, args.diffs,
+        ).max()
+        for part in parts
+    ])
+    makespan = finish.max()
+    return {
+        "workers": nworkers,
+        "partmethod": partmethod,
+        "partkey": partkey,
+        "makespan": makespan,
+        "imbalance": makespan / finish.mean() if finish.mean() else 1.0,
+        "finish": finish.tolist(),
+        "sizes": [len(part) for part in parts],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenario", type=str, help="scenario file")
+    parser.add_argument("-n", type=int, nargs="+", required=True, help="numbers of workers to try")
+    parser.add_argument("--partmethod", type=str, nargs="+", default=["mod"],
+            choices=["mod", "div"], help="partition methods to try")
+    parser.add_argument("--partkey", type=int, nargs="+", default=[0],
+            help="partition keys to try, 0 means the number of workers for mod, "
+            "and an even split of the nodes for div")
+    parser.add_argument("--nodenum", type=int, default=0,
+            help="number of nodes, default is the largest node + 1")
+    parser.add_argument("--xy", type=str, help="read the number of nodes from this .xy file")
+    parser.add_argument("--service", type=float, default=1e-4,
+            help="search time per query, in seconds")
+    parser.add_argument("--parts", type=str, help="fit --service from a previous parts.csv")
+    parser.add_argument("--expe", type=int, default=0, help="experiment (diff) to read from --parts")
+    parser.add_argument("--jitter", type=float, default=0,
+            help="coefficient of variation of the search time of a query")
+    parser.add_argument("--overhead", type=float, default=0.05,
+            help="transport overhead per batch, in seconds")
+    parser.add_argument("--threads", type=int, default=1, help="search threads per worker")
+    parser.add_argument("--batch-size", type=int, default=0,
+            help="micro-batch size, 0 sends each shard at once")
+    parser.add_argument("--replicas", type=int, default=1, help="replicas per shard")
+    parser.add_argument("--diffs", type=int, default=1, help="number of diffs")
+    parser.add_argument("--deadline", type=float, help="deadline in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", type=str, help="write the results to this JSON file")
+    args = parser.parse_args(argv[1:])
+
+    reqs = read_p2p(args.scenario)
+    nodenum = args.nodenum
+    if args.xy is not None:
+        nodenum = get_node_num(args.xy)
+    nodenum = max(nodenum, int(reqs.max()) + 1 if len(reqs) else 0)
+    if args.parts is not None:
+        args.service = fit_service(args.parts, args.expe)
+        print(f"Fitted search time: {args.service * 1e6:.2f}us per query")
+
+    results = []
+    for n, method, key in itertools.product(args.n, args.partmethod, args.partkey):
+        if key <= 0:
+            key = n if method == "mod" else -(-nodenum // n)
+        rng = np.random.default_rng(args.seed)
+        res = simulate(reqs, nodenum, n, method, key, args, rng)
+        if args.deadline is not None:
+            res["meets_deadline"] = bool(res["makespan"] <= args.deadline)
+        results.append(res)
+        print(f"{n:5} workers {method}:{key:<8} makespan {res['makespan']:10.3f}s "
+              f"imbalance {res['imbalance']:.3f}"
+              + ("" if args.deadline is None else
+                 f" {'meets' if res['meets_deadline'] else 'misses'} deadline"))
+
+    if args.o is not None:
+        with open(args.o, "w") as f:
+            json.dump(results, f)
+
+
+if __name__ == "__main__":
+    main()
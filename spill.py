@@ -0,0 +1,90 @@
+#
+# Out-of-core partitioning of a scenario on the head node.
+# The text scenario is read a chunk at a time and each chunk is routed, by the
+# worker of its targets, straight to per-worker spill files already in the
+# query file format of the resident processes. Memory stays bounded by the
+# chunk size and the node table, whatever the size of the scenario.
+#
+# The number of queries heads a query file but is only known at the end: a
+# fixed-width placeholder is written first and patched once the file is
+# complete.
+#
+import os
+
+import numpy as np
+
+import wire
+from partition import group_by, WID
+from scenario import iter_p2p, CHUNK_BYTES
+
+
+# Buffer of each spill file, in bytes
+BUFFER_BYTES = 1 << 20
+# Width of the query count line of a text spill file, newline excluded
+COUNT_WIDTH = 20
+
+
+class SpillFile:
+    """Query file of a shard, appended to a chunk at a time"""
+
+    def __init__(self, name, config, dname, flags=0):
+        self.name = name
+        self.binary = config.get("wire") == "binary"
+        self.did = wire.diff_id(dname)
+        self.chash = wire.config_hash(config)
+        self.flags = flags
+        self.count = 0
+        self.f = open(name, "wb" if self.binary else "w", buffering=BUFFER_BYTES)
+        self.write_header()
+
+    def __len__(self):
+        return self.count
+
+    def write_header(self):
+        if self.binary:
+            self.f.write(wire.HEADER.pack(wire.MAGIC_QUERY, wire.VERSION, self.flags,
+                                          self.count, self.did, self.chash))
+        else:
+            self.f.write(f"{self.count:<{COUNT_WIDTH}}\n")
+
+    def append(self, reqs):
+        if self.binary:
+            self.f.write(np.ascontiguousarray(reqs, dtype=wire.QUERY))
+        else:
+            np.savetxt(self.f, reqs, fmt="%d")
+        self.count += len(reqs)
+
+    def close(self):
+        """Patch the query count and close the file"""
+        self.f.seek(0)
+        self.write_header()
+        self.f.close()
+
+    def remove(self):
+        if os.path.exists(self.name):
+            os.remove(self.name)
+
+
+def spill_p2p(sce_name, table, maxworker, wids, files, chunk_bytes=CHUNK_BYTES):
+    """
+    Route the queries of a text scenario to the spill files of the worker of
+    their target, in one pass. files[k] are the spill files of worker wids[k],
+    each gets all of its queries. Returns the number of queries read.
+    """
+    slot = np.full(maxworker, len(wids))
+    slot[list(wids)] = np.arange(len(wids))
+    total = 0
+    try:
+        for chunk in iter_p2p(sce_name, chunk_bytes):
+            total += len(chunk)
+            # Queries of workers not in wids go to an extra group, dropped
+            groups = group_by(slot[table[chunk[:, 1], WID]], len(wids) + 1)
+            for shard, idx in zip(files, groups):
+                if len(idx):
+                    for f in shard:
+                        f.append(chunk[idx])
+    finally:
+        for shard in files:
+            for f in shard:
+                f.close()
+    return total
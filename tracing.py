@@ -0,0 +1,97 @@
+#
+# Span tracing on top of Timer.
+# A Span is a Timer that, when tracing is on, also records its name, start
+# and duration on the track it ran on: the asyncio task when there is one
+# (each replica's load has its own task), otherwise the thread (e.g. query
+# files written from the thread pool). Spans on the same track nest.
+# The spans of a run are saved in the Chrome trace event format, to open in
+# chrome://tracing or https://ui.perfetto.dev.
+#
+import asyncio
+import json
+import os
+import threading
+import timeit
+
+from timer import Timer
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.origin = timeit.default_timer()
+        self.events = []
+        self.tracks = {}
+        self.lock = threading.Lock()
+
+    def track(self):
+        """
+        Id of the current asyncio task, or thread, as a trace tid. Tasks are
+        told apart by name: the id of a finished task is reused by later ones.
+        """
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is not None:
+            name = task.get_name()
+            key = ("task", name)
+        else:
+            thread = threading.current_thread()
+            key, name = thread.ident, thread.name
+        with self.lock:
+            if key not in self.tracks:
+                self.tracks[key] = (len(self.tracks) + 1, name)
+            return self.tracks[key][0]
+
+    def add(self, span, tid):
+        self.events.append({
+            "name": span.name,
+            "cat": span.cat,
+            "ph": "X",
+            "ts": (span.start - self.origin) * 1e6,
+            "dur": span.interval * 1e6,
+            "pid": os.getpid(),
+            "tid": tid,
+            "args": span.args,
+        })
+
+    def save(self, fname):
+        names = [
+            {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+             "args": {"name": name}}
+            for tid, name in self.tracks.values()
+        ]
+        with open(fname, "w") as f:
+            json.dump({"traceEvents": names + self.events, "displayTimeUnit": "ms"}, f)
+
+
+TRACER = Tracer()
+
+
+def enable():
+    TRACER.enabled = True
+
+
+def save(fname):
+    TRACER.save(fname)
+
+
+class Span(Timer):
+    """Timer of a named phase, recorded in the trace when tracing is on"""
+
+    def __init__(self, name, cat="", **args):
+        super().__init__()
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        # The track is that of the code entering the span
+        self.tid = TRACER.track() if TRACER.enabled else None
+        return super().__enter__()
+
+    def __exit__(self, *args):
+        super().__exit__(*args)
+        if self.tid is not None:
+            TRACER.add(self, self.tid)
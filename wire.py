@@ -0,0 +1,121 @@
+#
+# Binary query/answer format exchanged with the resident processes.
+#
+# Both directions start with the same little-endian header:
+#   magic (4s), version (u16), flags (u16), count (u64), diff id (u32),
+#   config hash (u32)
+# A query file is followed by `count` packed (source, target) uint32 pairs.
+# An answer is followed by one ANSWER record with the batch's statistics and,
+# if the query file had the PER_QUERY flag, `count` RESULT records (one per
+# query, `count` is 0 otherwise). The worker copies the flags, diff id and
+# config hash of the query file into its answer.
+# With the COMPRESSED flag, everything after the header is compressed with the
+# codec of the runtime configuration (see codec.py). The worker only compresses
+# the answers of compressed query files, and sets the flag of the answer
+# according to its own payload.
+#
+import json
+import struct
+import zlib
+
+import numpy as np
+
+from codec import compress, decompress
+
+
+# 2: one ANSWER record then `count` RESULT records (1 had `count` ANSWER records)
+VERSION = 2
+MAGIC_QUERY = b"DOSQ"
+MAGIC_ANSWER = b"DOSA"
+HEADER = struct.Struct("<4sHHQII")
+
+# Header flags
+PER_QUERY = 1
+COMPRESSED = 2
+
+QUERY = np.dtype("<u4")
+# Aggregate statistics of a batch, same fields as the text answer
+ANSWER = np.dtype(
+    [
+        ("n_expanded", "<u8"),
+        ("n_inserted", "<u8"),
+        ("n_touched", "<u8"),
+        ("n_updated", "<u8"),
+        ("n_surplus", "<u8"),
+        ("plen", "<f8"),
+        ("finished", "<u8"),
+        ("t_receive", "<f8"),
+        ("t_astar", "<f8"),
+        ("t_search", "<f8"),
+    ]
+)
+
+
+# Result of a single query, `index` is its position in the query file
+RESULT = np.dtype(
+    [
+        ("index", "<u4"),
+        ("cost", "<f8"),
+        ("n_expanded", "<u4"),
+        ("t_search", "<u8"),  # nanoseconds
+    ]
+)
+
+
+def diff_id(dname):
+    return zlib.crc32(dname.encode())
+
+
+def config_hash(config):
+    return zlib.crc32(json.dumps(config, sort_keys=True).encode())
+
+
+def write_queries(f, reqs, did, chash, flags=0, codec=None):
+    """Write the header and the (N, 2) query array to a binary file"""
+    body, packed = compress(codec, np.ascontiguousarray(reqs, dtype=QUERY).tobytes())
+    if packed:
+        flags |= COMPRESSED
+    f.write(HEADER.pack(MAGIC_QUERY, VERSION, flags, len(reqs), did, chash))
+    f.write(body)
+
+
+def body(buf, flags, codec=None):
+    """What follows the header, decompressed if needed"""
+    if flags & COMPRESSED:
+        return decompress(codec, memoryview(buf)[HEADER.size:])
+    return memoryview(buf)[HEADER.size:]
+
+
+def read_queries(buf, codec=None):
+    """The (N, 2) query array of a query file, and its header flags"""
+    _, _, flags, count, _, _ = read_header(buf, MAGIC_QUERY)
+    reqs = np.frombuffer(body(buf, flags, codec), dtype=QUERY, count=2 * count)
+    return reqs.reshape(-1, 2), flags
+
+
+def read_header(buf, magic):
+    if len(buf) < HEADER.size:
+        raise ValueError(f"Truncated header ({len(buf)} bytes)")
+    head = HEADER.unpack_from(buf)
+    if head[0] != magic:
+        raise ValueError(f"Bad magic {head[0]}, expected {magic}")
+    if head[1] != VERSION:
+        raise ValueError(f"Unsupported version {head[1]}")
+    return head
+
+
+def read_answers(buf, did, chash, codec=None):
+    """
+    Check the header of an answer and view its records without copying
+    (unless compressed).
+    Returns the ANSWER record and the RESULT records (None if not requested).
+    """
+    _, _, flags, count, adid, achash = read_header(buf, MAGIC_ANSWER)
+    if (adid, achash) != (did, chash):
+        raise ValueError(f"Answer for diff {adid:x}/config {achash:x}, "
+                         f"expected {did:x}/{chash:x}")
+    data = body(buf, flags, codec)
+    stats = np.frombuffer(data, dtype=ANSWER, count=1)[0]
+    if not flags & PER_QUERY:
+        return stats, None
+    return stats, np.frombuffer(data, dtype=RESULT, count=count, offset=ANSWER.itemsize)